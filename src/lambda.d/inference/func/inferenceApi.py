@@ -2,18 +2,18 @@ from __future__  import print_function
 import boto3
 import os, sys
 import json
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from neptune_python_utils.gremlin_utils import GremlinUtils
 from neptune_python_utils.endpoints import Endpoints
 from gremlin_python.process.graph_traversal import __
 from gremlin_python.process.traversal import Cardinality
-from gremlin_python.process.traversal import Column
 from io import BytesIO, StringIO
-from datetime import datetime as dt
 import numpy as np
-import pandas as pd
 import time
+import asyncio
 import logging
+from props_codec import encode_props, decode_props, columns_digest, ColumnsMismatchError
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -25,6 +25,19 @@ CLUSTER_REGION = os.environ['CLUSTER_REGION']
 ENDPOINT_NAME = os.environ['ENDPOINT_NAME']
 MODEL_BTW = float(os.environ['MODEL_BTW'])
 QUEUE_URL = os.environ['QUEUE_URL']
+CONNECTION_MAX_AGE = int(os.environ.get('CONNECTION_MAX_AGE', '3600'))
+CONNECTION_MAX_IDLE = int(os.environ.get('CONNECTION_MAX_IDLE', '60'))
+EMBEDDING_CACHE_SIZE = int(os.environ.get('EMBEDDING_CACHE_SIZE', '10000'))
+EMBEDDING_CACHE_TTL = int(os.environ.get('EMBEDDING_CACHE_TTL', '3600'))
+MODEL_VERSION_TTL = int(os.environ.get('MODEL_VERSION_TTL', '60'))
+ENDPOINT_CONTENT_TYPE = os.environ.get('ENDPOINT_CONTENT_TYPE', 'application/x-npz')
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'RealtimeFraudDetection/Inference')
+METRICS_WINDOW = int(os.environ.get('METRICS_WINDOW', '1000'))
+CONCURRENT_GRAPH_IO = os.environ.get('CONCURRENT_GRAPH_IO', 'false').lower() in ['true', '1', 'yes']
+PROJECTED_EMBEDDING_SIZE = int(os.environ.get('PROJECTED_EMBEDDING_SIZE', '0'))
+SCORE_LINKED_TRANSACTIONS = os.environ.get('SCORE_LINKED_TRANSACTIONS', 'false').lower() in ['true', '1', 'yes']
+# the endpoint looks up the embeddings of identity vertices in its own embedding store, they are neither read nor sent
+ENDPOINT_EMBEDDING_STORE = os.environ.get('ENDPOINT_EMBEDDING_STORE', 'false').lower() in ['true', '1', 'yes']
 
 transactions_id_cols = os.environ['TRANSACTION_ID_COLS']
 transactions_cat_cols = os.environ['TRANSACTION_CAT_COLS']
@@ -32,270 +45,640 @@ dummied_col = os.environ['DUMMIED_COL']
 
 sqs = boto3.client('sqs')
 runtime = boto3.client('runtime.sagemaker')
+sagemaker = boto3.client('sagemaker')
 
 attr_version_key = 'props_values'
+attr_cols = ['val'+str(x) for x in range(1,391)]
+attr_cols_digest = columns_digest(attr_cols)
+empty_attr_props = encode_props(np.zeros(len(attr_cols)), attr_cols, attr_cols_digest)
+
+# identity vertices are represented either by their embeddings, or by their embeddings projected by the first layer of
+# the model when PROJECTED_EMBEDDING_SIZE is the hidden size of the model
+if PROJECTED_EMBEDDING_SIZE > 0:
+    identity_embed_key = 'proj_values'
+    identity_embed_cols = ['proj'+str(x) for x in range(1,PROJECTED_EMBEDDING_SIZE+1)]
+    identity_embed_digest = columns_digest(identity_embed_cols)
+    # the endpoint projects NaN rows as the empty embedding of new identity vertices
+    empty_identity_embed_props = encode_props(np.full(len(identity_embed_cols), np.nan), identity_embed_cols, identity_embed_digest)
+else:
+    identity_embed_key = attr_version_key
+    identity_embed_cols = attr_cols
+    identity_embed_digest = attr_cols_digest
+    empty_identity_embed_props = empty_attr_props
 
 endpoints = Endpoints(neptune_endpoint = CLUSTER_ENDPOINT, neptune_port = CLUSTER_PORT, region_name = CLUSTER_REGION)
 
-def load_data_from_event(input_event, transactions_id_cols, transactions_cat_cols, dummied_col):
-    """Load and transform event data into correct format for next step subgraph loading and model inference input. 
-        input event keys should come from related dataset.]
-    
-    Example:
-    >>> load_data_from_event(event = {"transaction_data":[{"TransactionID":"3163166", "V1":1, ...]}, 'card1,card2,,...', 'M2_T,M3_F,M3_T,...')
+GremlinUtils.init_statics(globals())
+
+class GremlinConnectionPool:
+    """Keep the gremlin connection open across warm invocations of the function, so that the WebSocket handshake and
+    its IAM signing are only paid on cold start.
+
+    The connection is checked with a cheap traversal after being idle for CONNECTION_MAX_IDLE seconds, and is reopened
+    with freshly signed headers when it is unhealthy or older than CONNECTION_MAX_AGE seconds.
+    """
+    def __init__(self, endpoint, max_age = CONNECTION_MAX_AGE, max_idle = CONNECTION_MAX_IDLE):
+        self.gremlin_utils = GremlinUtils(endpoint)
+        self.max_age = max_age
+        self.max_idle = max_idle
+        self.conn = None
+        self.created_at = 0
+        self.used_at = 0
+
+    def reconnect(self):
+        self.close()
+        # every new connection signs its handshake request with current credentials
+        self.conn = self.gremlin_utils.remote_connection()
+        self.created_at = self.used_at = time.time()
+        logger.info('Opened a new gremlin connection.')
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except Exception as err:
+                logger.warning(f'Ignore error {err} on closing gremlin connection.')
+            self.conn = None
+
+    def is_healthy(self, g):
+        try:
+            g.inject(0).next()
+            return True
+        except Exception as err:
+            logger.warning(f'Gremlin connection failed health check with error {err}.')
+            return False
+
+    def traversal_source(self):
+        now = time.time()
+        if self.conn is None or now - self.created_at > self.max_age:
+            self.reconnect()
+        g = self.gremlin_utils.traversal_source(connection=self.conn)
+        if now - self.used_at > self.max_idle and not self.is_healthy(g):
+            self.reconnect()
+            g = self.gremlin_utils.traversal_source(connection=self.conn)
+        self.used_at = now
+        return g
+
+connection_pool = GremlinConnectionPool(endpoints)
+
+class EmbeddingCache:
+    """Bounded LRU cache of the parsed float32 embeddings of identity vertices, kept in the warm process.
+
+    Embeddings only change when a new model is loaded, so the cache is cleared whenever the model version changes.
+    Entries also expire after ttl seconds, hits and misses are counted for logging.
+    """
+    def __init__(self, max_size = EMBEDDING_CACHE_SIZE, ttl = EMBEDDING_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.model_version = None
+        self.hits = 0
+        self.misses = 0
+
+    def set_model_version(self, model_version):
+        if model_version != self.model_version:
+            logger.info(f'Clear {len(self.entries)} cached embeddings of model version {self.model_version}, new version is {model_version}.')
+            self.entries.clear()
+            self.model_version = model_version
+
+    def get(self, node_id):
+        entry = self.entries.get(node_id)
+        if entry is not None and time.time() - entry[1] > self.ttl:
+            del self.entries[node_id]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(node_id)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, node_id, embedding):
+        self.entries[node_id] = (embedding, time.time())
+        self.entries.move_to_end(node_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+embedding_cache = EmbeddingCache()
+
+class LatencyMetrics:
+    """Record the latency of the stages of an invocation as timing spans.
+
+    The spans of an invocation are emitted as one CloudWatch embedded metric format record, with the size buckets of
+    the scored subgraphs as dimensions. The latest `window` values of every stage are kept in the warm process to log
+    rolling p50/p95/p99 summaries.
+    """
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, namespace = METRICS_NAMESPACE, window = METRICS_WINDOW):
+        self.namespace = namespace
+        self.window = window
+        self.history = {}
+        self.start()
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        self.spans = OrderedDict()
+
+    def elapsed(self):
+        return time.perf_counter() - self.started_at
+
+    @contextmanager
+    def span(self, stage):
+        s_t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans[stage] = self.spans.get(stage, 0.0) + (time.perf_counter() - s_t) * 1000
+
+    @staticmethod
+    def size_bucket(size):
+        # the smallest power of two not less than size keeps the cardinality of dimensions low
+        return str(1 << max(size - 1, 0).bit_length())
+
+    def percentiles(self):
+        return {stage: dict(zip([f'p{p}' for p in self.PERCENTILES], np.percentile(values, self.PERCENTILES).round(3).tolist()))
+                for stage, values in self.history.items()}
+
+    def emit(self, num_nodes, num_edges):
+        self.spans['total'] = self.elapsed() * 1000
+        for stage, value in self.spans.items():
+            self.history.setdefault(stage, deque(maxlen=self.window)).append(value)
+
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [['SubgraphNodes', 'SubgraphEdges']],
+                    'Metrics': [{'Name': stage, 'Unit': 'Milliseconds'} for stage in self.spans],
+                }],
+            },
+            'SubgraphNodes': self.size_bucket(num_nodes),
+            'SubgraphEdges': self.size_bucket(num_edges),
+            'NodeCount': num_nodes,
+            'EdgeCount': num_edges,
+            **self.spans,
+        }
+        # embedded metric records must be printed as plain JSON lines without the prefix of logger
+        print(json.dumps(record))
+        logger.info(f'Rolling latency percentiles in milliseconds {self.percentiles()}.')
+
+latency_metrics = LatencyMetrics()
+
+model_version = {'name': None, 'checked_at': 0}
+
+def get_model_version(endpointname):
+    """Return the endpoint config name of the inference endpoint, which is named after the training job of the deployed
+    model. It is described again at most every MODEL_VERSION_TTL seconds.
+    """
+    now = time.time()
+    if model_version['name'] is None or now - model_version['checked_at'] > MODEL_VERSION_TTL:
+        try:
+            model_version['name'] = sagemaker.describe_endpoint(EndpointName=endpointname)['EndpointConfigName']
+        except Exception as err:
+            logger.warning(f'Failed to describe endpoint {endpointname} with error {err}, keep model version {model_version["name"]}.')
+        model_version['checked_at'] = now
+    return model_version['name']
+
+def transport_errors():
+    """The errors of a broken gremlin connection, of the websocket transport gremlin_python is installed with."""
+    errors = [OSError, asyncio.TimeoutError]
+    try:
+        from tornado.websocket import WebSocketError
+        errors.append(WebSocketError)
+    except ImportError:
+        pass
+    try:
+        from aiohttp import ClientError
+        errors.append(ClientError)
+    except ImportError:
+        pass
+    return tuple(errors)
+
+TRANSPORT_ERRORS = transport_errors()
+
+def reconnect_on_failure(func):
+    """Retry an operation of GraphModelClient once on a new connection when the pooled connection fails.
+    Only connection and transport errors are retried, errors of the gremlin server or the code are raised as they are.
+    """
+    def wrapper(self, *args, **kwargs):
+        try:
+            return func(self, *args, **kwargs)
+        except TRANSPORT_ERRORS as err:
+            logger.warning(f'{func.__name__} failed with error {err}, retry it with a new gremlin connection.')
+            self.connection_pool.reconnect()
+            return func(self, *args, **kwargs)
+    return wrapper
+
+class EventTransformer:
+    """Transform inference events into the property vectors and identity dicts of their transactions without pandas.
+    The column lists from environment are split and compiled once on cold start, the value columns derived from the
+    keys of event data are compiled once per event schema.
     """
     TRANSACTION_ID = 'TransactionID'
 
-    transactions_id_cols = transactions_id_cols.split(',') 
-    transactions_cat_cols = transactions_cat_cols.split(',') 
-    transactions_no_value_cols = [TRANSACTION_ID, 'TransactionDT'] + transactions_id_cols + transactions_cat_cols
-    dummied_col = dummied_col.split(',')
+    def __init__(self, transactions_id_cols, transactions_cat_cols, dummied_col):
+        self.transactions_id_cols = transactions_id_cols.split(',') 
+        transactions_cat_cols = transactions_cat_cols.split(',') 
+        self.transactions_no_value_cols = set([self.TRANSACTION_ID, 'TransactionDT'] + self.transactions_id_cols + transactions_cat_cols)
+        self.dummied_col = dummied_col.split(',')
+        self.dummies = [(dummy[:2], dummy[3:]) for dummy in self.dummied_col]
+        self.schemas = {}
+
+    def compile_schema(self, transaction_keys, identity_keys):
+        """Return neighbor columns, transaction value columns and its digest, and union identity columns of an event
+        schema."""
+        schema_key = (transaction_keys, identity_keys)
+        if schema_key not in self.schemas:
+            neighbor_cols = [x for x in transaction_keys if x not in self.transactions_no_value_cols]
+            transaction_value_cols = neighbor_cols + self.dummied_col
+            identities_cols = [x for x in identity_keys if x != self.TRANSACTION_ID]
+            union_id_cols = self.transactions_id_cols + identities_cols
+            self.schemas[schema_key] = (neighbor_cols, transaction_value_cols, columns_digest(transaction_value_cols), union_id_cols)
+        return self.schemas[schema_key]
+
+    @staticmethod
+    def is_missing(value):
+        # NaN is the only value not equal to itself
+        return value is None or value != value
+
+    def load_data_from_event(self, input_event):
+        """Load and transform event data into correct format for next step subgraph loading and model inference input. 
+            input event keys should come from related dataset. An event may carry several transactions, each of them is
+            transformed into its own entry of the returned lists, identity data is joined to transactions by TransactionID.]
+        
+        Example:
+        >>> event_transformer.load_data_from_event(event = {"transaction_data":[{"TransactionID":"3163166", "V1":1, ...]})
+        """
+        TRANSACTION_ID = self.TRANSACTION_ID
 
-    if input_event['identity_data'] != []:
-        identities_cols = list(input_event['identity_data'][0].keys())
-        identities_cols.remove(TRANSACTION_ID)
-    else:
-        identities_cols = []
+        transaction_keys = tuple(input_event['transaction_data'][0].keys())
+        identity_keys = tuple(input_event['identity_data'][0].keys()) if input_event['identity_data'] != [] else ()
+        neighbor_cols, transaction_value_cols, transaction_value_digest, union_id_cols = self.compile_schema(transaction_keys, identity_keys)
 
-    neighbor_cols = [x for x in list(input_event['transaction_data'][0].keys()) if x not in transactions_no_value_cols]
+        identities = {str(identity[TRANSACTION_ID]): identity for identity in input_event['identity_data']}
 
-    if input_event['identity_data'] != []:
-        input_event = {**input_event['transaction_data'][0], **input_event['identity_data'][0]} 
-    else:
-        input_event = {**input_event['transaction_data'][0]}
-    
-    input_event[TRANSACTION_ID] = f't-{input_event[TRANSACTION_ID]}'
-    input_event['TransactionAmt'] = np.log10(input_event['TransactionAmt'])
-    
-    inputDF = pd.DataFrame.from_dict(input_event, orient='index').transpose()
+        trans_dict, identity_dict, target_ids = [], [], []
+        for transaction in input_event['transaction_data']:
+            record = {**transaction, **identities.get(str(transaction[TRANSACTION_ID]), {})}
+            target_id = f't-{transaction[TRANSACTION_ID]}'
+            record['TransactionAmt'] = np.log10(record['TransactionAmt'])
 
-    union_id_cols = transactions_id_cols + identities_cols 
+            values = [0.0 if self.is_missing(record.get(col)) else record[col] for col in neighbor_cols]
+            values += [1.0 if record.get(col_name) == dummy_value else 0.0 for col_name, dummy_value in self.dummies]
+            trans_dict.append({TRANSACTION_ID: target_id,
+                                'props_values': encode_props(values, transaction_value_cols, transaction_value_digest)})
 
-    target_id = inputDF[TRANSACTION_ID].iloc[0]
+            # transactions without identity record only connect to their transaction id columns
+            identity_dict.append({col: 0.0 if self.is_missing(record[col]) else record[col]
+                                    for col in union_id_cols if col in record})
+            target_ids.append(target_id)
 
-    for dummy in dummied_col:
-        col_name = dummy[:2]
-        if inputDF[col_name].iloc[0] == dummy[3:]:
-            inputDF[dummy] = 1.0
-        else:
-            inputDF[dummy] = 0.0
-            
-    transaction_value_cols = neighbor_cols+dummied_col
-    
-    transformedDF = inputDF[transaction_value_cols].fillna(0.0).apply(lambda row: json.dumps(dict(row), default=str), axis=1).to_frame('json') 
-    trans_dict = [{TRANSACTION_ID:target_id,
-                    'props_values': transformedDF.iloc[0]['json']}]
-    logger.debug(f'transformed trans dict is {trans_dict}')
+        logger.debug(f'transformed trans dict is {trans_dict}')
 
-    identity_dict = [inputDF[union_id_cols].iloc[0].fillna(0.0).to_dict()]
-    return trans_dict, identity_dict, target_id, transaction_value_cols, union_id_cols
+        return trans_dict, identity_dict, target_ids, transaction_value_cols, union_id_cols
 
-class GraphModelClient:
-    def __init__(self, endpoint):
-        self.gremlin_utils = GremlinUtils(endpoint)
-        GremlinUtils.init_statics(globals())
+event_transformer = EventTransformer(transactions_id_cols, transactions_cat_cols, dummied_col)
 
-    def insert_new_transaction_vertex_and_edge(self, tr_dict, connectted_node_dict, target_id, vertex_type = 'Transaction'):
+class GraphModelClient:
+    def __init__(self, connection_pool, embedding_cache = None, metrics = None):
+        self.connection_pool = connection_pool
+        self.embedding_cache = embedding_cache
+        self.metrics = metrics if metrics is not None else LatencyMetrics()
+
+    def build_upsert_traversal(self, g, tr_dict, connectted_node_dict, target_ids, vertex_type = 'Transaction'):
+        """Build the single coalesce traversal upserting transaction vertices, their identity vertices and edges."""
+        def upsert_vertex(traversal, node_id, label, props):
+            add_vertex = __.addV(label).property(id, node_id)
+            for key, value in props.items():
+                add_vertex = add_vertex.property(Cardinality.single, key, value)
+            return traversal.coalesce(__.V(node_id), add_vertex)
+
+        def upsert_edge(traversal, from_label, edge_id):
+            # the edge goes from the labeled transaction vertex to current vertex
+            return traversal.coalesce(__.inE('CATEGORY').hasId(edge_id),
+                                        __.addE('CATEGORY').from_(from_label).property(id, edge_id))
+
+        empty_node_dict = {attr_version_key: empty_attr_props}
+
+        traversal = g.inject(0)
+        for i, (tr, connectted_nodes, target_id) in enumerate(zip(tr_dict, connectted_node_dict, target_ids)):
+            target_label = f't{i}'
+            traversal = upsert_vertex(traversal, target_id, vertex_type, tr).as_(target_label)
+            for node_k, node_v in connectted_nodes.items():
+                node_id = node_k + '-' + str(node_v)
+                traversal = upsert_vertex(traversal, node_id, node_k, empty_node_dict)
+                traversal = upsert_edge(traversal, target_label, target_id + '-' + node_id)
+            logger.debug(f'Upsert_Vertex: {target_id} with edges to {len(connectted_nodes)} vertices.')
+        return traversal
+
+    @reconnect_on_failure
+    def insert_new_transaction_vertex_and_edge(self, tr_dict, connectted_node_dict, target_ids, vertex_type = 'Transaction'):
         """Load transaction data, insert transaction object and related domain objects into GraphDB as vertex,
-        with their properties as values, and insert their relation as edges.
+        with their properties as values, and insert their relation as edges. 
+        The vertices and edges of all transactions are upserted by a single coalesce traversal, which only adds the ones
+        not existing yet. It takes one round trip regardless of the number of identity columns and is safe to retry.
             
         Example:
-        >>> insert_new_transaction_vertex_and_edge(tr_dict, connectted_node_dict, target_id, vertex_type = 'Transaction')
+        >>> insert_new_transaction_vertex_and_edge(tr_dict, connectted_node_dict, target_ids, vertex_type = 'Transaction')
         """
-        def insert_attr(graph_conn, attr_val_dict, target_id, node_id, vertex_type): 
-
-            if (not g.V().has(id,node_id).hasNext()):
-                logger.info(f'Insert_Vertex: {node_id}.')
-                g.inject(attr_val_dict).unfold().as_(vertex_type).\
-                addV(vertex_type).as_('v').property(id,node_id).\
-                sideEffect(__.select(vertex_type).unfold().as_('kv').select('v').\
-                    property(Cardinality.single, __.select('kv').by(Column.keys),
-                                __.select('kv').by(Column.values)
-                                )
-                    ).iterate()
-            else:
-                logger.debug(f'Ignore inserting existing Vertex with id {node_id}')
-
-            # Insert_edge
-
-            to_node = g.V().has(id,node_id).next()
-            edgeId = target_id+'-'+node_id
-            if(not g.E().has(id,edgeId).hasNext()):
-                logger.info(f'Insert_Edge: {target_id} --> {node_id}.')
-                g.V().has(id,target_id).addE('CATEGORY').to(to_node).property(id,edgeId).iterate() 
-            else:
-                logger.debug(f'Ignore inserting existing edge with id {edgeId}')                
-        
-        conn = self.gremlin_utils.remote_connection()
-        g = self.gremlin_utils.traversal_source(connection=conn) 
-
-        if (not g.V().has(id, target_id).hasNext()):
-            logger.info(f'Insert_Vertex: {target_id}.')
-            g.inject(tr_dict).unfold().as_(vertex_type).\
-            addV(vertex_type).as_('v').property(id,target_id).\
-            sideEffect(__.select(vertex_type).unfold().as_('kv').select('v').\
-                property(Cardinality.single, __.select('kv').by(Column.keys),
-                            __.select('kv').by(Column.values)
-                            )
-                ).iterate()         
-                
-        cols = {'val' + str(i + 1): '0.0' for i in range(390)}
-        for node_k, node_v in connectted_node_dict[0].items():
-            node_id = node_k + '-' + str(node_v)
-            empty_node_dict = {}
-            empty_node_dict[attr_version_key] = json.dumps(cols)
-            empty_node_dict = [empty_node_dict]
-            insert_attr(g, empty_node_dict, target_id, node_id, vertex_type = node_k)   
-
-        conn.close()                    
+        g = self.connection_pool.traversal_source()
+
+        self.build_upsert_traversal(g, tr_dict, connectted_node_dict, target_ids, vertex_type).iterate()
+        logger.info(f'Upserted {len(target_ids)} transactions with their vertices and edges.')
+
+    def lookup_cached_embeds(self, connectted_node_dict):
+        """Return the cached embeddings of identity vertices connected to the targets."""
+        cached_embeds = {}
+        if self.embedding_cache is not None:
+            for connectted_nodes in connectted_node_dict:
+                for node_k, node_v in connectted_nodes.items():
+                    node_id = node_k + '-' + str(node_v)
+                    if node_id not in cached_embeds:
+                        cached_embeds[node_id] = self.embedding_cache.get(node_id)
+            cached_embeds = {node_id: embed for node_id, embed in cached_embeds.items() if embed is not None}
+        return cached_embeds
                     
-    def query_target_subgraph(self, target_id, tr_dict, transaction_value_cols, union_id_cols, dummied_col):
+    @reconnect_on_failure
+    def query_target_subgraph(self, target_ids, tr_dict, connectted_node_dict, transaction_value_cols, union_id_cols, dummied_col):
         """Extract 2nd degree subgraph of target transaction.Dump data into subgraph dict and n_feats dict.
         subgraph_dict:  related transactions' id list and values through edges
         n_feats dict: related 1 degree vertex and transactions' embeded elements vectors. 
         Usually after insert new test sample's vertex and edges into graphDB. 
+        The identity vertices of all targets, their embeddings, neighbor transactions and the properties of those
+        transactions are fetched by one projected traversal, identity vertices shared by several targets are only
+        fetched once. The embeddings of identity vertices found in the embedding cache are not fetched at all.
+        Return a (subgraph_dict, n_feats dict) pair per target.
         
         Example:
-        >>> query_target_subgraph('3661635', load_data_from_event(), 'M2_T,M3_F,M3_T,...')
+        >>> query_target_subgraph(['t-3661635'], trans_dict, identity_dict, 'M2_T,M3_F,M3_T,...')
         """
-        subgraph_dict = {}
-        neighbor_list = []
-        neighbor_dict = {}
-        transaction_embed_value_dict = {}
-        
-        ii = 0
-        s_t = dt.now()
-        
-        conn = self.gremlin_utils.remote_connection()
-        g = self.gremlin_utils.traversal_source(connection=conn) 
-
-        target_name = target_id[(target_id.find('-')+1):]
-        feature_list = g.V().has(id,target_id).out().id().toList()
-        for feat in feature_list:
-            ii += 1
-            feat_name = feat[:feat.find('-')]
-            feat_value = feat[(feat.find('-')+1):]
-            node_list = g.V().has(id,feat).both().limit(MAX_FEATURE_NODE).id().toList()
-            target_and_conn_node_list = [int(target_name)]+[int(target_conn_node[(target_conn_node.find('-')+1):]) for target_conn_node in node_list]
-            target_and_conn_node_list = list(set(target_and_conn_node_list))
-            neighbor_list += target_and_conn_node_list
-            nodes_and_feature_value_array = (target_and_conn_node_list,[feat_value]*len(target_and_conn_node_list))
-            subgraph_dict['target<>'+feat_name] = nodes_and_feature_value_array
-        
-        e_t = dt.now()
-        logger.info(f'INSIDE query_target_subgraph: subgraph_dict used {(e_t - s_t).total_seconds()} seconds')
-        new_s_t = e_t
-
-        union_li = [__.V().has(id,target_id).both().hasLabel(label).both().limit(MAX_FEATURE_NODE) for label in union_id_cols]
-
-        if len(union_id_cols) == 51:
-            node_dict = g.V().has(id,target_id).union(__.both().hasLabel('card1').both().limit(MAX_FEATURE_NODE),\
-                    union_li[1], union_li[2], union_li[3], union_li[4], union_li[5],\
-                    union_li[6], union_li[7], union_li[8], union_li[9], union_li[10],\
-                    union_li[11], union_li[12], union_li[13], union_li[14], union_li[15],\
-                    union_li[16], union_li[17], union_li[18], union_li[19], union_li[20],\
-                    union_li[21], union_li[22], union_li[23], union_li[24], union_li[25],\
-                    union_li[26], union_li[27], union_li[28], union_li[29], union_li[30],\
-                    union_li[31], union_li[32], union_li[33], union_li[34], union_li[35],\
-                    union_li[36], union_li[37], union_li[38], union_li[39], union_li[40],\
-                    union_li[41], union_li[42], union_li[43], union_li[44], union_li[45],\
-                    union_li[46], union_li[47], union_li[48], union_li[49], union_li[50]).elementMap().toList()
-        else:
-            node_dict = g.V().has(id,target_id).union(__.both().hasLabel('card1').both().limit(MAX_FEATURE_NODE),\
-                    union_li[1], union_li[2], union_li[3], union_li[4], union_li[5],\
-                    union_li[6], union_li[7], union_li[8], union_li[9], union_li[10]).elementMap().toList()
+        def identity_vertices():
+            # only relations known by the model are part of the subgraph
+            return __.out().hasLabel(*union_id_cols) if union_id_cols else __.out()
 
-        e_t = dt.now()
-        logger.info(f'INSIDE query_target_subgraph: node_dict used {(e_t - new_s_t).total_seconds()} seconds.')
-        new_s_t = e_t
+        cached_embeds = self.lookup_cached_embeds(connectted_node_dict)
 
-        logger.debug(f'Found {len(node_dict)} nodes from graph dbs...')
-        
-        class Item():
-            def __init__(self, item):
-                self.item = item
-        
-            def __hash__(self):
-                return hash(self.item.get(list(self.item)[0]))
-        
-            def __eq__(self,other):
-                if isinstance(other, self.__class__):
-                    return self.__hash__() == other.__hash__()
-                else:
-                    return NotImplemented
-        
-            def __repr__(self):
-                return "Item(%s)" % (self.item)
-                
-        node_dict = list(set([Item(node) for node in node_dict]))
-        logger.debug(f'Found {len(node_dict)} nodes without duplication')
-        for item in node_dict:
-            item = item.item
-            node = item.get(list(item)[0])
-            node_value = node[(node.find('-')+1):]
-            try:
-                logger.debug(f'the props of node {node} is {item.get(attr_version_key)}')
-                jsonVal = json.loads(item.get(attr_version_key))
-                neighbor_dict[node_value] = [jsonVal[key] for key in transaction_value_cols]
-                logger.debug(f'neighbor pair is {node_value}, {neighbor_dict[node_value]}')
-            except json.JSONDecodeError:
-                logger.warn(f'Malform node value {node} is {item.get(attr_version_key)}, run below cmd to remove it')
-                logger.info(f'g.V(\'{node}\').drop()')
-
-        target_value = target_id[(target_id.find('-')+1):]
-        jsonVal = json.loads(tr_dict[0].get(attr_version_key))
-        neighbor_dict[target_value] = [jsonVal[key] for key in transaction_value_cols]
-        
-        logger.info(f'INSIDE query_target_subgraph: neighbor_dict used {(e_t - new_s_t).total_seconds()} seconds.')
-
-        attr_cols = ['val'+str(x) for x in range(1,391)]
-        for attr in feature_list:
-            attr_name = attr[:attr.find('-')]
-            attr_value = attr[(attr.find('-')+1):]
-            attr_dict = g.V().has(id,attr).valueMap().toList()[0]
-            logger.debug(f'attr is {attr}, dict is {attr_dict}')
-            jsonVal = json.loads(attr_dict.get(attr_version_key)[0])
-            attr_dict = [float(jsonVal[key]) for key in attr_cols]
-            attr_input_dict = {}
-            attr_input_dict[attr_value] = attr_dict
-            transaction_embed_value_dict[attr_name] = attr_input_dict
-        
-        e_t = dt.now()
-        logger.info(f'INSIDE query_target_subgraph: transaction_embed_value_dict used {(e_t - new_s_t).total_seconds()} seconds. Total test cost {(e_t - s_t).total_seconds()} seconds.')
-        new_s_t = e_t
+        if ENDPOINT_EMBEDDING_STORE:
+            identity_embed = __.values(identity_embed_key).limit(0).fold()
+        elif cached_embeds:
+            identity_embed = __.not_(__.hasId(*cached_embeds.keys())).values(identity_embed_key).fold()
+        else:
+            identity_embed = __.values(identity_embed_key).fold()
+
+        g = self.connection_pool.traversal_source()
+
+        with self.metrics.span('query_traversal'):
+            result = g.V(*target_ids).fold().project('targets', 'features').\
+                by(__.unfold().project('id', 'features').
+                    by(id).
+                    by(identity_vertices().id().fold()).
+                    fold()).\
+                by(__.unfold().flatMap(identity_vertices()).dedup().project('id', 'props', 'neighbors').
+                    by(id).
+                    by(identity_embed).
+                    by(__.both().limit(MAX_FEATURE_NODE).project('id', 'props').
+                        by(id).
+                        by(__.values(attr_version_key).fold()).
+                        fold()).
+                    fold()).\
+                next()
+
+        target_features = {target['id']: target['features'] for target in result['targets']}
+        features = {feat['id']: feat for feat in result['features']}
+        logger.debug(f'Found {len(features)} identity vertices from graph dbs...')
+
+        return self.assemble_subgraphs(target_ids, tr_dict, target_features, features, cached_embeds, transaction_value_cols)
+
+    @reconnect_on_failure
+    def insert_and_query_target_subgraph(self, target_ids, tr_dict, connectted_node_dict, transaction_value_cols, vertex_type = 'Transaction'):
+        """Upsert the transactions like insert_new_transaction_vertex_and_edge and extract their subgraphs like
+        query_target_subgraph, with the write and the reads running concurrently on an asyncio event loop.
         
-        transaction_embed_value_dict['target'] = neighbor_dict
-
-        conn.close()   
-
-        return subgraph_dict, transaction_embed_value_dict    
-
-def invoke_endpoint_with_idx(endpointname, target_id, subgraph_dict, n_feats):
+        Example:
+        >>> insert_and_query_target_subgraph(['t-3661635'], trans_dict, identity_dict, transaction_value_cols)
+        """
+        # the pool may reconnect with blocking calls of the gremlin transport, so it is not touched inside the event loop
+        g = self.connection_pool.traversal_source()
+        return asyncio.run(self.insert_and_query_target_subgraph_async(g, target_ids, tr_dict, connectted_node_dict, transaction_value_cols, vertex_type))
+
+    async def insert_and_query_target_subgraph_async(self, g, target_ids, tr_dict, connectted_node_dict, transaction_value_cols, vertex_type = 'Transaction'):
+        """The identity vertices of targets are known from the event, so their neighbors and embeddings are read without
+        waiting for the new vertices and edges to be written. The reads are completed with what the write adds: the
+        empty embedding of identity vertices not existing yet and the transactions of this event as their neighbors.
+        """
+        cached_embeds = self.lookup_cached_embeds(connectted_node_dict)
+        target_features = {target_id: [node_k + '-' + str(node_v) for node_k, node_v in connectted_nodes.items()]
+                            for target_id, connectted_nodes in zip(target_ids, connectted_node_dict)}
+        identity_ids = list(dict.fromkeys(node_id for node_ids in target_features.values() for node_id in node_ids))
+        uncached_ids = [] if ENDPOINT_EMBEDDING_STORE else [node_id for node_id in identity_ids if node_id not in cached_embeds]
+
+        def collect(traversal, cb):
+            return asyncio.wrap_future(traversal.promise(cb))
+
+        async def no_result():
+            return []
+
+        upsert = collect(self.build_upsert_traversal(g, tr_dict, connectted_node_dict, target_ids, vertex_type), lambda t: t.iterate())
+        if identity_ids:
+            neighbors = collect(g.V(*identity_ids).project('id', 'neighbors').
+                                    by(id).
+                                    by(__.both().limit(MAX_FEATURE_NODE).project('id', 'props').
+                                        by(id).
+                                        by(__.values(attr_version_key).fold()).
+                                        fold()), lambda t: t.toList())
+        else:
+            neighbors = no_result()
+        if uncached_ids:
+            embeds = collect(g.V(*uncached_ids).project('id', 'props').
+                                by(id).
+                                by(__.values(identity_embed_key).fold()), lambda t: t.toList())
+        else:
+            embeds = no_result()
+
+        with self.metrics.span('concurrent_traversal'):
+            _, neighbors_result, embeds_result = await asyncio.gather(upsert, neighbors, embeds)
+
+        # identity vertices not existing yet are written with the empty embedding
+        features = {node_id: {'props': [empty_identity_embed_props], 'neighbors': []} for node_id in identity_ids}
+        for node in neighbors_result:
+            features[node['id']]['neighbors'] = node['neighbors']
+        for node in embeds_result:
+            if node['props']:
+                features[node['id']]['props'] = node['props']
+        # the transactions of this event are neighbors of their identity vertices once written
+        for target_id, tr in zip(target_ids, tr_dict):
+            for node_id in target_features[target_id]:
+                features[node_id]['neighbors'].append({'id': target_id, 'props': [tr[attr_version_key]]})
+
+        return self.assemble_subgraphs(target_ids, tr_dict, target_features, features, cached_embeds, transaction_value_cols)
+
+    def assemble_subgraphs(self, target_ids, tr_dict, target_features, features, cached_embeds, transaction_value_cols):
+        """Build the (subgraph_dict, n_feats dict) pair of every target from the identity vertex ids of targets and the
+        neighbors and embeddings of identity vertices."""
+        def node_value(node_id):
+            return node_id[(node_id.find('-')+1):]
+
+        transaction_value_digest = columns_digest(transaction_value_cols)
+
+        with self.metrics.span('query_assemble'):
+            subgraphs = []
+            for target_id, tr in zip(target_ids, tr_dict):
+                subgraph_dict = {}
+                neighbor_dict = {}
+                transaction_embed_value_dict = {}
+
+                target_value = node_value(target_id)
+                for feat_id in target_features.get(target_id, []):
+                    feat = features[feat_id]
+                    feat_name = feat_id[:feat_id.find('-')]
+                    feat_value = node_value(feat_id)
+
+                    target_and_conn_node_list = [int(target_value)]
+                    for node in feat['neighbors']:
+                        conn_node_value = node_value(node['id'])
+                        target_and_conn_node_list.append(int(conn_node_value))
+                        if conn_node_value in neighbor_dict:
+                            continue
+                        try:
+                            logger.debug(f'the props of node {node["id"]} is {node["props"]}')
+                            neighbor_dict[conn_node_value] = decode_props(node['props'][0], transaction_value_cols, transaction_value_digest).tolist()
+                        except ColumnsMismatchError:
+                            # the columns of the graph and the function differ, dropping every neighbor would only hide it
+                            logger.error(f'Node {node["id"]} is encoded with other transaction columns than {transaction_value_cols}, check the columns of the ETL output and the function.')
+                            raise
+                        except (IndexError, KeyError, ValueError):
+                            logger.warn(f'Malform node value {node["id"]} is {node["props"]}, run below cmd to remove it')
+                            logger.info(f'g.V(\'{node["id"]}\').drop()')
+                    target_and_conn_node_list = list(set(target_and_conn_node_list))
+                    nodes_and_feature_value_array = (target_and_conn_node_list,[feat_value]*len(target_and_conn_node_list))
+                    subgraph_dict['target<>'+feat_name] = nodes_and_feature_value_array
+
+                    if ENDPOINT_EMBEDDING_STORE:
+                        continue
+                    if feat_id not in cached_embeds:
+                        # vertices written by the inference have no projected embeddings
+                        props = feat['props'][0] if feat['props'] else empty_identity_embed_props
+                        cached_embeds[feat_id] = decode_props(props, identity_embed_cols, identity_embed_digest)
+                        if self.embedding_cache is not None:
+                            self.embedding_cache.put(feat_id, cached_embeds[feat_id])
+                    transaction_embed_value_dict[feat_name] = {feat_value: cached_embeds[feat_id].tolist()}
+
+                neighbor_dict[target_value] = decode_props(tr.get(attr_version_key), transaction_value_cols, transaction_value_digest).tolist()
+                transaction_embed_value_dict['target'] = neighbor_dict
+                subgraphs.append((subgraph_dict, transaction_embed_value_dict))
+
+        if self.embedding_cache is not None:
+            logger.info(f'INSIDE assemble_subgraphs: embedding cache stats {self.embedding_cache.stats()}.')
+
+        return subgraphs    
+
+NPZ_CONTENT_TYPE = 'application/x-npz'
+JSON_CONTENT_TYPE = 'application/json'
+
+endpoint_content_type = {'value': ENDPOINT_CONTENT_TYPE}
+
+# errors of endpoint code without binary support parsing the npz body as JSON
+NPZ_UNSUPPORTED_ERRORS = ['JSONDecodeError', 'Expecting value', "codec can't decode"]
+
+def is_npz_unsupported(err):
+    message = str(err)
+    return any(error in message for error in NPZ_UNSUPPORTED_ERRORS)
+
+def encode_npz_payload(target_ids, subgraph_dicts, n_feats):
+    """
+    Pack subgraphs into a npz container of typed arrays, which is much smaller and faster to parse than JSON.
+    For the i-th subgraph, the container holds 'graph/<i>/<relation>/src' and 'graph/<i>/<relation>/dst' edge arrays,
+    'n_feats/<i>/<node type>/ids' node id arrays with the matching 'n_feats/<i>/<node type>/values' float32 feature
+    matrices, and 'target_id' holds the target ids of all subgraphs. A subgraph with a list of target ids also has
+    them in 'target_ids/<i>'.
+    
+    Example:
+    >>> encode_npz_payload([3636131], [subgraph_dict], [transaction_embed_value_dict])
+    """
+    arrays = {'target_id': np.asarray([target_id[0] if isinstance(target_id, list) else target_id
+                                       for target_id in target_ids], dtype=np.int64)}
+    for i, (target_id, subgraph_dict, n_feat) in enumerate(zip(target_ids, subgraph_dicts, n_feats)):
+        if isinstance(target_id, list):
+            arrays[f'target_ids/{i}'] = np.asarray(target_id, dtype=np.int64)
+        for rel, (src, dst) in subgraph_dict.items():
+            arrays[f'graph/{i}/{rel}/src'] = np.asarray(src)
+            arrays[f'graph/{i}/{rel}/dst'] = np.asarray(dst)
+        for ntype, feats in n_feat.items():
+            arrays[f'n_feats/{i}/{ntype}/ids'] = np.asarray(list(feats.keys()))
+            arrays[f'n_feats/{i}/{ntype}/values'] = np.asarray(list(feats.values()), dtype=np.float32)
+
+    buf = BytesIO()
+    np.savez(buf, **arrays)
+    return buf.getvalue()
+
+def invoke_endpoint_with_idx(endpointname, target_ids, subgraph_dicts, n_feats):
     """
     Post data input to and request response from sagemaker inference endpoint.
+    Several subgraphs are merged into one batch payload, which is scored by the endpoint in a single forward pass.
+    The payload is a binary npz container by default, and falls back to JSON when ENDPOINT_CONTENT_TYPE asks for it or
+    the endpoint fails to parse the binary payload, i.e. it is still serving code without binary support.
     
     Example:
-    >>> invoke_endpoint_with_idx('frauddetection', '3636131', subgraph_dict, transaction_embed_value_dict)
+    >>> invoke_endpoint_with_idx('frauddetection', [3636131], [subgraph_dict], [transaction_embed_value_dict])
 
     Args:
     
     endpointname: Neptune endpoint string from environ
-    target_id: transaction id for inference. default to be event['TransactionID']
-    subgraph_dict: testgraphpath
-    n_feats: transaction_embed_values
+    target_ids: transaction ids for inference. default to be event['TransactionID']. A list of transaction ids scores
+                all of them with the same subgraph
+    subgraph_dicts: testgraphpath of each transaction
+    n_feats: transaction_embed_values of each transaction
+
+    Return:
 
+    a list of predicted probabilities in the order of target_ids, with a list of probabilities for a list of ids
     """
+    def group_probs(probs):
+        # the endpoint lists the probabilities of all targets of all subgraphs
+        pred_probs = []
+        offset = 0
+        for target_id in target_ids:
+            if isinstance(target_id, list):
+                pred_probs.append(probs[offset:offset + len(target_id)])
+                offset += len(target_id)
+            else:
+                pred_probs.append(probs[offset])
+                offset += 1
+        return pred_probs
     
-    payload = {
+    if endpoint_content_type['value'] == NPZ_CONTENT_TYPE:
+        try:
+            response = runtime.invoke_endpoint(EndpointName=endpointname,
+                                                    ContentType=NPZ_CONTENT_TYPE,
+                                                    Body=encode_npz_payload(target_ids, subgraph_dicts, n_feats))
+            res_body = response['Body'].read()
+            logger.debug(f'Invoke endpoint with response {res_body}')
+
+            # the results of npz requests are always a list
+            return group_probs(json.loads(res_body))
+        except runtime.exceptions.ModelError as err:
+            # other model errors, e.g. bad input or transient failures, are not fixed by another content type
+            if not is_npz_unsupported(err):
+                raise
+            logger.warning(f'Endpoint could not parse {NPZ_CONTENT_TYPE} payload with error {err}, fall back to {JSON_CONTENT_TYPE}.')
+            endpoint_content_type['value'] = JSON_CONTENT_TYPE
+
+    payloads = [{
         'graph': subgraph_dict,
-        'n_feats': n_feats,
+        'n_feats': n_feat,
         'target_id': target_id
-    }
+    } for target_id, subgraph_dict, n_feat in zip(target_ids, subgraph_dicts, n_feats)]
+    payload = payloads[0] if len(payloads) == 1 else {'batch': payloads}
     
     logger.debug(f'Invoke endpoint with data {payload}')
     
     response = runtime.invoke_endpoint(EndpointName=endpointname,
-                                            ContentType='application/json',
+                                            ContentType=JSON_CONTENT_TYPE,
                                             Body=json.dumps(payload))
 
     res_body = response['Body'].read()
@@ -304,10 +687,32 @@ def invoke_endpoint_with_idx(endpointname, target_id, subgraph_dict, n_feats):
     
     results = json.loads(res_body)
     
-    pred_prob = results
+    return group_probs(results if isinstance(results, list) else [results])
+
 
-    return pred_prob
+QUEUE_SEND_ATTEMPTS = 3
 
+def publish_to_queue(entries):
+    """
+    Send the messages of entries to the queue in batches, retrying the entries failed by SQS.
+    Raise an error if some entries still fail after QUEUE_SEND_ATTEMPTS attempts, as send_message does.
+    """
+    # SQS accepts at most 10 messages per batch request
+    for i in range(0, len(entries), 10):
+        pending = entries[i:i + 10]
+        for attempt in range(QUEUE_SEND_ATTEMPTS):
+            response = sqs.send_message_batch(
+                QueueUrl=QUEUE_URL,
+                Entries=pending,
+            )
+            failed = response.get('Failed', [])
+            if not failed:
+                break
+            logger.warning(f'Failed to send transactions {failed} to queue in attempt {attempt + 1}.')
+            failed_ids = {entry['Id'] for entry in failed}
+            pending = [entry for entry in pending if entry['Id'] in failed_ids]
+        else:
+            raise RuntimeError(f'Failed to send transactions {failed} to queue.')
 
 def handler(event, context):
     
@@ -315,70 +720,92 @@ def handler(event, context):
     
     logger.info(f'Receive event: {event}')
 
-    G_s_t = dt.now()
+    latency_metrics.start()
 
-    trans_dict, identity_dict, target_id, transaction_value_cols, union_li_cols = load_data_from_event(event, transactions_id_cols, transactions_cat_cols, dummied_col)
-    
-    G_e_t = dt.now()
-    logger.info(f'load_data_from_event used {(G_e_t - G_s_t).total_seconds()} seconds. ')
-    G_new_s_t = G_e_t
-    
-    graph_input = GraphModelClient(endpoints)
-    graph_input.insert_new_transaction_vertex_and_edge(trans_dict, identity_dict , target_id, vertex_type = 'Transaction')
-    
-    G_e_t = dt.now()
-    logger.info(f'insert_new_transaction_vertex_and_edge used {(G_e_t - G_new_s_t).total_seconds()} seconds. Total test cost {(G_e_t - G_s_t).total_seconds()} seconds.')
-    G_new_s_t = G_e_t
-    
-    subgraph_dict, transaction_embed_value_dict = graph_input.query_target_subgraph(target_id, trans_dict, transaction_value_cols, union_li_cols, dummied_col)
+    with latency_metrics.span('load'):
+        trans_dict, identity_dict, target_ids, transaction_value_cols, union_li_cols = event_transformer.load_data_from_event(event)
     
-    G_e_t = dt.now()
-    logger.info(f'query_target_subgraph used {(G_e_t - G_new_s_t).total_seconds()} seconds. Total test cost {(G_e_t - G_s_t).total_seconds()} seconds.')
-    G_new_s_t = G_e_t
+    embedding_cache.set_model_version(get_model_version(ENDPOINT_NAME))
+    graph_input = GraphModelClient(connection_pool, embedding_cache, latency_metrics)
+    if CONCURRENT_GRAPH_IO:
+        with latency_metrics.span('insert_and_query'):
+            subgraphs = graph_input.insert_and_query_target_subgraph(target_ids, trans_dict, identity_dict, transaction_value_cols, vertex_type = 'Transaction')
+    else:
+        with latency_metrics.span('insert'):
+            graph_input.insert_new_transaction_vertex_and_edge(trans_dict, identity_dict , target_ids, vertex_type = 'Transaction')
+        
+        with latency_metrics.span('query'):
+            subgraphs = graph_input.query_target_subgraph(target_ids, trans_dict, identity_dict, transaction_value_cols, union_li_cols, dummied_col)
 
-    transaction_id = int(target_id[(target_id.find('-')+1):])
+    transaction_ids = [int(target_id[(target_id.find('-')+1):]) for target_id in target_ids]
+    subgraph_dicts = [subgraph_dict for subgraph_dict, _ in subgraphs]
+    transaction_embed_value_dicts = [transaction_embed_value_dict for _, transaction_embed_value_dict in subgraphs]
     
-    pred_prob = invoke_endpoint_with_idx(endpointname = ENDPOINT_NAME, target_id = transaction_id, subgraph_dict = subgraph_dict, n_feats = transaction_embed_value_dict)
-    
-    e_t = dt.now()
-    logger.info(f'invoke_endpoint_with_idx used {(G_e_t - G_new_s_t).total_seconds()} seconds. Total test cost {(G_e_t - G_s_t).total_seconds()} seconds.')
-    G_new_s_t = G_e_t
-
-    data_output = {
-                    'timestamp': int(time.time()),
-                    'isFraud': pred_prob > MODEL_BTW,
-                    'id': transaction_id, #event['transaction_data'][0]['TransactionID'],
-                    'amount': event['transaction_data'][0]['TransactionAmt'],
-                    'productCD': event['transaction_data'][0]['ProductCD'],
-                    'card1': event['transaction_data'][0]['card1'],
-                    'card2': event['transaction_data'][0]['card2'],
-                    'card3': event['transaction_data'][0]['card3'],
-                    'card4': event['transaction_data'][0]['card4'],
-                    'card5': event['transaction_data'][0]['card5'],
-                    'card6': event['transaction_data'][0]['card6'],
-                    'addr1': event['transaction_data'][0]['addr1'],
-                    'addr2': event['transaction_data'][0]['addr2'],
-                    'dist1': event['transaction_data'][0]['dist1'],
-                    'dist2': event['transaction_data'][0]['dist2'],
-                    'pEmaildomain': event['transaction_data'][0]['P_emaildomain'],
-                    'rEmaildomain': event['transaction_data'][0]['R_emaildomain'],
-                }
-
-    logger.debug(f'Send transaction {data_output} to queue.')
-    response = sqs.send_message(
-        QueueUrl=QUEUE_URL,
-        DelaySeconds=0,
-        MessageBody=json.dumps(data_output),
-        MessageGroupId=context.aws_request_id,
-    )
+    if SCORE_LINKED_TRANSACTIONS:
+        # re-score the transactions linked to each transaction through its identities with the same forward pass
+        linked_ids = [sorted({node_id for src, _ in subgraph_dict.values() for node_id in src} - {transaction_id})
+                      for transaction_id, subgraph_dict in zip(transaction_ids, subgraph_dicts)]
+        score_ids = [[transaction_id] + linked for transaction_id, linked in zip(transaction_ids, linked_ids)]
+    else:
+        score_ids = transaction_ids
+
+    with latency_metrics.span('invoke_endpoint'):
+        pred_probs = invoke_endpoint_with_idx(endpointname = ENDPOINT_NAME, target_ids = score_ids, subgraph_dicts = subgraph_dicts, n_feats = transaction_embed_value_dicts)
+
+    if SCORE_LINKED_TRANSACTIONS:
+        linked_probs = [dict(zip(linked, probs[1:])) for linked, probs in zip(linked_ids, pred_probs)]
+        pred_probs = [probs[0] for probs in pred_probs]
     
-    function_res = {
-                    'id': event['transaction_data'][0]['TransactionID'],
-                    'flag': pred_prob > MODEL_BTW,
-                    'pred_prob': pred_prob,
-                    'time': (G_e_t - G_s_t).total_seconds()
+    inference_time = latency_metrics.elapsed()
+
+    function_res = []
+    entries = []
+    for i, (transaction, transaction_id, pred_prob) in enumerate(zip(event['transaction_data'], transaction_ids, pred_probs)):
+        data_output = {
+                        'timestamp': int(time.time()),
+                        'isFraud': pred_prob > MODEL_BTW,
+                        'id': transaction_id, #transaction['TransactionID'],
+                        'amount': transaction['TransactionAmt'],
+                        'productCD': transaction['ProductCD'],
+                        'card1': transaction['card1'],
+                        'card2': transaction['card2'],
+                        'card3': transaction['card3'],
+                        'card4': transaction['card4'],
+                        'card5': transaction['card5'],
+                        'card6': transaction['card6'],
+                        'addr1': transaction['addr1'],
+                        'addr2': transaction['addr2'],
+                        'dist1': transaction['dist1'],
+                        'dist2': transaction['dist2'],
+                        'pEmaildomain': transaction['P_emaildomain'],
+                        'rEmaildomain': transaction['R_emaildomain'],
                     }
+
+        logger.debug(f'Send transaction {data_output} to queue.')
+        entries.append({
+                        'Id': str(i),
+                        'DelaySeconds': 0,
+                        'MessageBody': json.dumps(data_output),
+                        'MessageGroupId': context.aws_request_id,
+                        })
+        
+        function_res.append({
+                        'id': transaction['TransactionID'],
+                        'flag': pred_prob > MODEL_BTW,
+                        'pred_prob': pred_prob,
+                        'time': inference_time
+                        })
+        if SCORE_LINKED_TRANSACTIONS:
+            function_res[-1]['linked_pred_probs'] = linked_probs[i]
+
+    with latency_metrics.span('publish_queue'):
+        publish_to_queue(entries)
+
+    num_nodes = sum(len(feats) for n_feat in transaction_embed_value_dicts for feats in n_feat.values())
+    num_edges = sum(len(src) for subgraph_dict in subgraph_dicts for src, _ in subgraph_dict.values())
+    latency_metrics.emit(num_nodes, num_edges)
     
     logger.info(f'Return function_res {function_res}.')
     
-    return function_res
\ No newline at end of file
+    # keep the response of single transaction event as it is
+    return function_res[0] if len(function_res) == 1 else function_res
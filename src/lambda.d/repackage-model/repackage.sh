@@ -26,6 +26,10 @@ main() {
   aws s3 sync $code_package "$MODEL_DIR/code"
   tar -xvf "$WORK_DIR"/model.tar.gz -C "$MODEL_DIR" --exclude='*.csv'
   mv "$MODEL_DIR/metadata.pkl" "$MODEL_DIR/code"
+  # the endpoint only loads the inference checkpoint when it exists, drop the full one with node embedding tables
+  if [[ -f "$MODEL_DIR/model_inference.pth" ]]; then
+    rm -f "$MODEL_DIR/model.pth"
+  fi
   tar -czf "$WORK_DIR"/model-repackaged.tar.gz -C "$MODEL_DIR" .
   aws s3 cp "$WORK_DIR"/model-repackaged.tar.gz $target_model
 }
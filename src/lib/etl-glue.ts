@@ -245,7 +245,10 @@ export class ETLByGlue extends Construct {
         '--enable-continuous-cloudwatch-log': 'true',
         '--enable-continuous-log-filter': 'false',
         '--enable-metrics': '',
-        '--extra-py-files': [glueJobBucket.s3UrlForObject(`${libPrefix}/${neptuneGlueConnectorLibName}`)].join(','),
+        '--extra-py-files': [
+          glueJobBucket.s3UrlForObject(`${libPrefix}/${neptuneGlueConnectorLibName}`),
+          glueJobBucket.s3UrlForObject(`${scriptPrefix}/props_codec.py`),
+        ].join(','),
         '--additional-python-modules': 'koalas==1.8.1',
       },
       role: glueJobRole.roleArn,
@@ -68,7 +68,10 @@ export class InferenceStack extends NestedStack {
     props.neptune.connections.allowDefaultPortFrom(inferenceSG, 'access from inference job.');
 
     this.inferenceFn.addToRolePolicy(new PolicyStatement({
-      actions: ['sagemaker:InvokeEndpoint'],
+      actions: [
+        'sagemaker:InvokeEndpoint',
+        'sagemaker:DescribeEndpoint',
+      ],
       resources: [
         Stack.of(this).formatArn({
           service: 'sagemaker',
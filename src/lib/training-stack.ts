@@ -599,6 +599,9 @@ export class TrainingStack extends NestedStack {
         environmentVariables: TaskInput.fromObject({
           SAGEMAKER_PROGRAM: 'fd_sl_deployment_entry_point.py',
           HIDDEN_SIZE: TaskInput.fromJsonPathAt('$.parameters.trainingJob.hyperparameters[\'n-hidden\']').value,
+          // let the model server batch concurrent requests, which the endpoint code scores by one forward pass
+          SAGEMAKER_TS_BATCH_SIZE: '8',
+          SAGEMAKER_TS_MAX_BATCH_DELAY: '5',
         }),
       }),
       resultPath: '$.modelOutput',
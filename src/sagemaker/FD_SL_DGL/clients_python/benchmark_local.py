@@ -0,0 +1,147 @@
+import argparse
+import contextlib
+import glob
+import json
+import os
+import pickle
+import resource
+import sys
+import time
+
+import numpy as np
+import torch as th
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
+
+import fd_sl_deployment_entry_point as entry_point
+
+JSON_CONTENT_TYPE = 'application/json'
+
+
+def load_payloads(payload_dir, target_id):
+    """
+    Load the recorded request payloads of a directory, as (name, request_body, content_type) tuples.
+    A payload is either a '.json' or '.npz' request body sent to the endpoint, or a '.pkl' subgraph file in the format
+    of client_boto_demo.py, which is scored for target_id.
+    """
+    payloads = []
+    for file_path in sorted(glob.glob(os.path.join(payload_dir, '*'))):
+        name = os.path.basename(file_path)
+        if file_path.endswith('.json'):
+            with open(file_path, 'rb') as f:
+                payloads.append((name, f.read(), JSON_CONTENT_TYPE))
+        elif file_path.endswith('.npz'):
+            with open(file_path, 'rb') as f:
+                payloads.append((name, f.read(), entry_point.NPZ_CONTENT_TYPE))
+        elif file_path.endswith('.pkl'):
+            with open(file_path, 'rb') as f:
+                graph_dict = pickle.load(f)
+            body = json.dumps({'graph': graph_dict['subgraph_dict'],
+                               'n_feats': graph_dict['n_feat_dict'],
+                               'target_id': target_id})
+            payloads.append((name, body, JSON_CONTENT_TYPE))
+
+    return payloads
+
+
+def synthetic_payloads(model, sizes):
+    """Generate JSON payloads of synthetic subgraphs with the given numbers of target nodes."""
+    etypes = list(model.layers[0].weight.keys())
+    payloads = []
+    for size in sizes:
+        graph_dict, n_feats, target_id = entry_point.make_synthetic_subgraph(etypes, model.layers[0].in_size,
+                                                                              num_targets=size,
+                                                                              num_identities=max(size // 4, 1),
+                                                                              seed=size)
+        body = json.dumps({'graph': {rel: (src.tolist(), dst.tolist()) for rel, (src, dst) in graph_dict.items()},
+                           'n_feats': {ntype: dict(zip(ids.astype(str).tolist(), values.tolist()))
+                                       for ntype, (ids, values) in n_feats.items()},
+                           'target_id': target_id})
+        payloads.append(('synthetic-{}'.format(size), body, JSON_CONTENT_TYPE))
+
+    return payloads
+
+
+def size_bucket(graph):
+    """The power of 2 bucket of the number of edges of a request graph."""
+    num_edges = sum(graph.number_of_edges(can_etype) for can_etype in graph.canonical_etypes)
+    return 1 << max(num_edges - 1, 0).bit_length()
+
+
+def percentiles(values):
+    return 'p50 {:8.3f}  p95 {:8.3f}  p99 {:8.3f}'.format(*np.percentile(values, [50, 95, 99]))
+
+
+def run_benchmark(model, payloads, rounds, warmup, verbose):
+    """Run every payload through input_fn and predict_fn, and return the stage latencies in ms per size bucket."""
+    latencies = {}
+    # logs of the entry point are discarded, not buffered, to keep them out of the process peak RSS
+    with open(os.devnull, 'w') as devnull:
+        quiet = contextlib.suppress() if verbose else contextlib.redirect_stdout(devnull)
+
+        with quiet:
+            for _ in range(warmup):
+                for _, body, content_type in payloads:
+                    entry_point.predict_fn(entry_point.input_fn(body, content_type), model)
+
+        s_t = time.perf_counter()
+        for _ in range(rounds):
+            for _, body, content_type in payloads:
+                with quiet:
+                    t0 = time.perf_counter()
+                    input_data = entry_point.input_fn(body, content_type)
+                    t1 = time.perf_counter()
+                    entry_point.predict_fn(input_data, model)
+                    t2 = time.perf_counter()
+
+                stages = latencies.setdefault(size_bucket(input_data[0]),
+                                              {'input_fn': [], 'predict_fn': [], 'total': []})
+                stages['input_fn'].append((t1 - t0) * 1000)
+                stages['predict_fn'].append((t2 - t1) * 1000)
+                stages['total'].append((t2 - t0) * 1000)
+        elapsed = time.perf_counter() - s_t
+
+    return latencies, rounds * len(payloads) / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the inference entry point in process')
+    parser.add_argument('--model_dir', type=str, default='../model', help='Folder of the model files')
+    parser.add_argument('--payload_dir', type=str, default='./', help='Folder of recorded payloads')
+    parser.add_argument('--target_id', type=int, default='3189753', help='Target node ID of .pkl subgraph files')
+    parser.add_argument('--synthetic_sizes', type=str, default='',
+                        help='Comma separated numbers of target nodes of synthetic subgraphs to add, e.g. 4,64,512')
+    parser.add_argument('--threads', type=str, default='',
+                        help='Comma separated torch intra-op thread counts to sweep, e.g. 1,2,4')
+    parser.add_argument('--rounds', type=int, default=10, help='Rounds over all payloads')
+    parser.add_argument('--warmup', type=int, default=1, help='Warm-up rounds over all payloads')
+    parser.add_argument('--verbose', action='store_true', help='Keep the logs of the entry point')
+
+    args = parser.parse_args()
+
+    # metadata.pkl of models without the inference checkpoint is looked up in the model folder
+    entry_point.BASE_PATH = os.path.join(args.model_dir, '')
+
+    s_t = time.perf_counter()
+    model = entry_point.model_fn(args.model_dir)
+    print('Model loaded in {:.3f} ms'.format((time.perf_counter() - s_t) * 1000))
+
+    payloads = load_payloads(args.payload_dir, args.target_id)
+    if args.synthetic_sizes:
+        payloads += synthetic_payloads(model, [int(size) for size in args.synthetic_sizes.split(',')])
+    if not payloads:
+        sys.exit('No payloads found in {}'.format(args.payload_dir))
+    print('Payloads: {}'.format(len(payloads)))
+
+    thread_counts = [int(threads) for threads in args.threads.split(',')] if args.threads else [th.get_num_threads()]
+    for threads in thread_counts:
+        th.set_num_threads(threads)
+        latencies, throughput = run_benchmark(model, payloads, args.rounds, args.warmup, args.verbose)
+
+        # ru_maxrss is the high-water mark of the process, so it covers the model loading and every earlier sweep
+        print('==== Threads: {}  Throughput: {:.1f} requests/s  Process peak RSS so far: {:.1f} MB'.format(
+            threads, throughput, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+        for bucket in sorted(latencies):
+            for stage, values in latencies[bucket].items():
+                print('edges <= {:6d}  {:10s}  {}  (ms, {} requests)'.format(bucket, stage, percentiles(values),
+                                                                             len(values)))
@@ -13,7 +13,10 @@
 
 
 import os
+import io
+import glob
 import json
+import time
 import dgl
 from datetime import datetime as dt
 import pickle
@@ -33,6 +36,26 @@ EMBEDDING_SIZE = 390
 BASE_PATH = '/opt/ml/model/code/'
 TARGET_FEAT_MEAN = None
 TARGET_FEAT_STD = None
+NPZ_CONTENT_TYPE = 'application/x-npz'
+INFERENCE_CHECKPOINT = 'model_inference.pth'
+# CPU inference mode, 'fp32' or 'int8' for dynamic int8 quantization of linear layers
+INFERENCE_MODE = os.getenv('INFERENCE_MODE', 'fp32')
+QUANTIZATION_TOLERANCE = float(os.getenv('QUANTIZATION_TOLERANCE', '0.05'))
+# Torch threads of each model server worker, the intra-op threads default to an even split of the cores between the
+# workers, which the model server starts one per core unless SAGEMAKER_MODEL_SERVER_WORKERS is set
+MODEL_SERVER_WORKERS = int(os.getenv('SAGEMAKER_MODEL_SERVER_WORKERS', str(os.cpu_count())))
+INTRA_OP_THREADS = int(os.getenv('INTRA_OP_THREADS', str(max(1, os.cpu_count() // MODEL_SERVER_WORKERS))))
+INTER_OP_THREADS = int(os.getenv('INTER_OP_THREADS', '0'))
+# Graph engine of the forward pass, 'dgl' for DGL heterographs or 'star' for index-based tensor ops on edge arrays
+INFERENCE_ENGINE = os.getenv('INFERENCE_ENGINE', 'dgl')
+STAR_PARITY_TOLERANCE = 1e-5
+# Warm-up rounds of synthetic subgraphs with the given numbers of target nodes when loading model, 0 to skip warm-up
+WARMUP_ROUNDS = int(os.getenv('WARMUP_ROUNDS', '0'))
+WARMUP_SIZES = [int(size) for size in os.getenv('WARMUP_SIZES', '1,8,64').split(',')]
+# Embeddings of non-target nodes exported by training, used for the node types requests send no features of
+EMBEDDING_STORE_DIR = 'embeddings'
+EMBEDDING_STORE_FALLBACK = os.getenv('EMBEDDING_STORE_FALLBACK', 'zero')
+EMBEDDING_STORE = None
 
 
 def load_train_graph_info(file_path):
@@ -65,31 +88,93 @@ def initialize_arguments(metadata_file):
     return ntype_dict, etypes, input_size, hidden_size, out_size, n_layers, embedding_size
 
 
+class StarGraph(object):
+    """
+    A lightweight stand-in of a DGL heterogeneous graph for the 'star' engine, only holding the edge index tensors of
+    each canonical edge type and the number of nodes of each type.
+    """
+    def __init__(self, rel_dict, num_nodes_dict):
+        self.rel_dict = rel_dict
+        self.num_nodes_dict = num_nodes_dict
+        self.canonical_etypes = list(rel_dict.keys())
+        self.ntypes = sorted(num_nodes_dict.keys())
+
+    def edges(self, etype):
+        return self.rel_dict[etype]
+
+    def number_of_nodes(self, ntype):
+        return self.num_nodes_dict.get(ntype, 0)
+
+    def number_of_edges(self, etype):
+        return self.rel_dict[etype][0].shape[0]
+
+    def __repr__(self):
+        return 'StarGraph(num_nodes={}, num_edges={})'.format(
+            self.num_nodes_dict, {etype: self.number_of_edges(etype) for etype in self.canonical_etypes})
+
+
 # RGCN models
 class HeteroRGCNLayer(nn.Module):
     def __init__(self, in_size, out_size, etypes):
         super(HeteroRGCNLayer, self).__init__()
+        self.in_size = in_size
         # W_r for each relation
         self.weight = nn.ModuleDict({
                 name: nn.Linear(in_size, out_size) for name in etypes
             })
 
-    def forward(self, G, feat_dict):
-        # The input is a dictionary of node features for each type
+    def project(self, srctype, etype, feat_dict, proj_dict):
+        if proj_dict is not None and etype in proj_dict:
+            Wh = proj_dict[etype]
+            # rows of nodes without a projection are NaN, the projection of their empty embedding is the bias
+            unknown = th.isnan(Wh).all(dim=1, keepdim=True)
+            bias = self.weight[etype].bias
+            # bias is a method of dynamically quantized linear layers
+            bias = bias() if callable(bias) else bias
+            return th.where(unknown, bias.expand_as(Wh), Wh)
+        # Compute W_r * h
+        if srctype in feat_dict:
+            return self.weight[etype](feat_dict[srctype])
+        return None
+
+    def forward(self, G, feat_dict, proj_dict=None):
+        # The input is a dictionary of node features for each type, and optionally a dictionary of node features
+        # already projected by W_r for each relation
+        if isinstance(G, StarGraph):
+            return self.forward_star(G, feat_dict, proj_dict)
+
         funcs = {}
         for srctype, etype, dsttype in G.canonical_etypes:
-            # Compute W_r * h
-            if srctype in feat_dict:
-                Wh = self.weight[etype](feat_dict[srctype])
-                # Save it in graph for message passing
-                G.nodes[srctype].data['Wh_%s' % etype] = Wh
-                # Specify per-relation message passing functions: (message_func, reduce_func).
-                funcs[etype] = (fn.copy_u('Wh_%s' % etype, 'm'), fn.mean('m', 'h'))
+            Wh = self.project(srctype, etype, feat_dict, proj_dict)
+            if Wh is None:
+                continue
+            # Save it in graph for message passing
+            G.nodes[srctype].data['Wh_%s' % etype] = Wh
+            # Specify per-relation message passing functions: (message_func, reduce_func).
+            funcs[etype] = (fn.copy_u('Wh_%s' % etype, 'm'), fn.mean('m', 'h'))
         # Trigger message passing of multiple types.
         G.multi_update_all(funcs, 'sum')
         # return the updated node feature dictionary
         return {ntype: G.nodes[ntype].data['h'] for ntype in G.ntypes if 'h' in G.nodes[ntype].data}
 
+    def forward_star(self, G, feat_dict, proj_dict=None):
+        # The same message passing as forward, the mean of messages per relation is a scatter-add of the projected
+        # source features over destination indices divided by in-degrees, and relations are summed per node type.
+        h_dict = {}
+        for can_etype in G.canonical_etypes:
+            srctype, etype, dsttype = can_etype
+            Wh = self.project(srctype, etype, feat_dict, proj_dict)
+            if Wh is None:
+                continue
+            src, dst = G.edges(etype=can_etype)
+            num_dst = G.number_of_nodes(dsttype)
+            msg_sum = Wh.new_zeros((num_dst, Wh.shape[1])).index_add_(0, dst, Wh[src])
+            # nodes without in-edges get zeros as DGL's mean reducer
+            in_deg = th.bincount(dst, minlength=num_dst).clamp(min=1).unsqueeze(1).to(Wh.dtype)
+            h = msg_sum / in_deg
+            h_dict[dsttype] = h_dict[dsttype] + h if dsttype in h_dict else h
+        return h_dict
+
 
 class HeteroRGCN(nn.Module):
     def __init__(self, ntype_dict, etypes, in_size, hidden_size, out_size, n_layers, embedding_size):
@@ -114,13 +199,20 @@ class HeteroRGCN(nn.Module):
 
         # To use in real-time case, need to set embedding with input embeddings that are extracted from GrahpDB.
         # h_dict = self.embed
-        h_dict = features
+        # Non-target features narrower than the input size are embeddings already projected by the first layer's
+        # weight of the relation to target nodes.
+        in_size = self.layers[0].in_size
+        proj_dict = {ntype + '<>target': h for ntype, h in features.items()
+                     if ntype != 'target' and h.shape[1] != in_size}
+        h_dict = {ntype: h for ntype, h in features.items() if ntype + '<>target' not in proj_dict}
 
         # pass through all layers
         for i, layer in enumerate(self.layers[:-1]):
             if i != 0:
                 h_dict = {k: F.leaky_relu(h) for k, h in h_dict.items()}
-            h_dict = layer(g, h_dict)
+                h_dict = layer(g, h_dict)
+            else:
+                h_dict = layer(g, h_dict, proj_dict)
 
         # get user binary logits
         bin_logist = self.layers[-1](h_dict['target'])
@@ -132,6 +224,154 @@ class HeteroRGCN(nn.Module):
         return softmax_logits
 
 
+def load_inference_checkpoint(file_path):
+    """
+    Build the RGCN model from the inference-only checkpoint exported by training, which holds the layer weights, the
+    model sizes and the normalization stats of target features, but not the embedding tables of non-target nodes.
+    """
+    checkpoint = th.load(file_path)
+
+    global TARGET_FEAT_MEAN
+    TARGET_FEAT_MEAN = checkpoint['feat_mean']
+    global TARGET_FEAT_STD
+    TARGET_FEAT_STD = checkpoint['feat_std']
+
+    # no node embedding tables, the embeddings of non-target nodes come with requests
+    rgcn_model = HeteroRGCN({}, checkpoint['etypes'], checkpoint['in_size'], checkpoint['hidden_size'],
+                            checkpoint['out_size'], checkpoint['n_layers'], checkpoint['in_size'])
+    rgcn_model.load_state_dict(checkpoint['state_dict'])
+
+    return rgcn_model
+
+
+def set_torch_threads(intra_op_threads, inter_op_threads):
+    """Pin the torch thread pools of this process, so that several model server workers do not oversubscribe cores."""
+    if intra_op_threads > 0:
+        th.set_num_threads(intra_op_threads)
+    if inter_op_threads > 0:
+        try:
+            th.set_num_interop_threads(inter_op_threads)
+        except RuntimeError as e:
+            # the inter-op pool can only be sized before it starts
+            print('--Keep inter-op threads {}: {}'.format(th.get_num_interop_threads(), e))
+    print('--Torch threads: intra-op {}, inter-op {}'.format(th.get_num_threads(), th.get_num_interop_threads()))
+
+
+def make_synthetic_subgraph(etypes, in_size, num_targets=4, num_identities=2, seed=0):
+    """
+    Generate a random request subgraph shaped like real ones, where target nodes connect to identity nodes of every
+    type related to target nodes.
+
+    :return: a (graph_dict, n_feats, target_id) tuple as accepted by recreate_grpha_data.
+    """
+    rng = np.random.RandomState(seed)
+    target_ids = np.arange(num_targets)
+    graph_dict = {}
+    n_feats = {'target': (target_ids, rng.rand(num_targets, in_size).astype(np.float32))}
+    identity_types = sorted({etype.split('<>')[0] for etype in etypes
+                             if etype.endswith('<>target') and not etype.startswith('target<>')})
+    for ntype in identity_types:
+        graph_dict['target<>' + ntype] = (target_ids, rng.randint(num_identities, size=num_targets))
+        n_feats[ntype] = (np.arange(num_identities), rng.rand(num_identities, in_size).astype(np.float32))
+
+    return graph_dict, n_feats, 0
+
+
+def quantize_model(model):
+    """
+    Apply dynamic int8 quantization to the relation and output linear layers, and compare its scores with the fp32
+    model on a synthetic subgraph. The fp32 model is kept when they differ by more than QUANTIZATION_TOLERANCE.
+    """
+    quantized_model = th.quantization.quantize_dynamic(model, {nn.Linear}, dtype=th.qint8)
+
+    etypes = list(model.layers[0].weight.keys())
+    graph, new_n_feats, _ = recreate_grpha_data(*make_synthetic_subgraph(etypes, model.layers[0].in_size))
+    with th.no_grad():
+        fp32_logits = model(graph, new_n_feats)
+        int8_logits = quantized_model(graph, new_n_feats)
+    max_diff = (fp32_logits - int8_logits).abs().max().item()
+    print('--Quantization parity: max score difference {:.6f}'.format(max_diff))
+
+    if max_diff > QUANTIZATION_TOLERANCE:
+        print('--Quantized model exceeds tolerance {}, keep the fp32 model'.format(QUANTIZATION_TOLERANCE))
+        return model
+
+    return quantized_model
+
+
+def check_star_parity(model):
+    """
+    Compare the scores of the 'star' engine with the DGL engine on a synthetic subgraph, and switch back to the DGL
+    engine when they differ.
+    """
+    global INFERENCE_ENGINE
+    etypes = list(model.layers[0].weight.keys())
+    request = make_synthetic_subgraph(etypes, model.layers[0].in_size)
+    with th.no_grad():
+        INFERENCE_ENGINE = 'dgl'
+        graph, new_n_feats, _ = recreate_grpha_data(*request)
+        dgl_logits = model(graph, new_n_feats)
+        INFERENCE_ENGINE = 'star'
+        graph, new_n_feats, _ = recreate_grpha_data(*request)
+        star_logits = model(graph, new_n_feats)
+    max_diff = (dgl_logits - star_logits).abs().max().item()
+    print('--Star engine parity: max score difference {:.8f}'.format(max_diff))
+
+    if max_diff > STAR_PARITY_TOLERANCE:
+        print('--Star engine exceeds tolerance {}, use the DGL engine'.format(STAR_PARITY_TOLERANCE))
+        INFERENCE_ENGINE = 'dgl'
+
+
+def warm_up(model, rounds, sizes):
+    """
+    Run synthetic subgraphs of the given numbers of target nodes through recreate_grpha_data and predict_fn, so that
+    lazy kernel initialization and allocator growth are paid before the first real requests.
+    """
+    etypes = list(model.layers[0].weight.keys())
+    for size in sizes:
+        request = make_synthetic_subgraph(etypes, model.layers[0].in_size, num_targets=size,
+                                          num_identities=max(size // 4, 1), seed=size)
+        durations = []
+        for _ in range(rounds):
+            s_t = time.time()
+            predict_fn(recreate_grpha_data(*request), model)
+            durations.append((time.time() - s_t) * 1000)
+        print('--Warm-up {} targets: first {:.3f} ms, last {:.3f} ms, {} rounds'.format(
+            size, durations[0], durations[-1], rounds))
+
+
+class EmbeddingStore(object):
+    """
+    Memory-mapped embeddings of non-target node types, looked up by the original node ids. Ids unseen in training get
+    a zero embedding, the same as the empty embedding of new identity vertices, or the mean embedding of their type.
+    """
+    def __init__(self, store_dir, fallback='zero'):
+        self.tables = {}
+        for file_path in glob.glob(os.path.join(store_dir, '*_index.npz')):
+            ntype = os.path.basename(file_path)[:-len('_index.npz')]
+            with np.load(file_path, allow_pickle=False) as index:
+                ids, mean = index['ids'], index['mean']
+            embeds = np.load(os.path.join(store_dir, ntype + '.npy'), mmap_mode='r')
+            sorter = np.argsort(ids)
+            default = mean if fallback == 'mean' else np.zeros_like(mean)
+            self.tables[ntype] = (ids[sorter], sorter, embeds, default)
+
+    def __contains__(self, ntype):
+        return ntype in self.tables
+
+    def gather(self, ntype, node_ids):
+        """Return a float32 matrix of the embeddings of node_ids."""
+        sorted_ids, sorter, embeds, default = self.tables[ntype]
+        query_ids = np.asarray(node_ids).astype(str)
+        pos = np.minimum(np.searchsorted(sorted_ids, query_ids), sorted_ids.size - 1)
+        found = sorted_ids[pos] == query_ids
+
+        feats = np.empty((query_ids.size, embeds.shape[1]), dtype=np.float32)
+        feats[found] = embeds[sorter[pos[found]]]
+        feats[~found] = default
+        return feats
+
+
 # SageMaker inference functions
 def model_fn(model_dir):
 
@@ -139,14 +379,36 @@ def model_fn(model_dir):
     # --- load saved model ---
     s_t = dt.now()
 
-    ntype_dict, etypes, in_size, hidden_size, out_size, n_layers, embedding_size = \
-    initialize_arguments(os.path.join(BASE_PATH, 'metadata.pkl'))
+    set_torch_threads(INTRA_OP_THREADS, INTER_OP_THREADS)
+
+    checkpoint_file = os.path.join(model_dir, INFERENCE_CHECKPOINT)
+    if os.path.exists(checkpoint_file):
+        rgcn_model = load_inference_checkpoint(checkpoint_file)
+    else:
+        # models trained before the inference-only checkpoint was exported
+        ntype_dict, etypes, in_size, hidden_size, out_size, n_layers, embedding_size = \
+        initialize_arguments(os.path.join(BASE_PATH, 'metadata.pkl'))
 
-    rgcn_model = HeteroRGCN(ntype_dict, etypes, in_size, hidden_size, out_size, n_layers, embedding_size)
+        rgcn_model = HeteroRGCN(ntype_dict, etypes, in_size, hidden_size, out_size, n_layers, embedding_size)
 
-    stat_dict = th.load('model.pth')
+        stat_dict = th.load(os.path.join(model_dir, 'model.pth'))
 
-    rgcn_model.load_state_dict(stat_dict)
+        rgcn_model.load_state_dict(stat_dict)
+
+    rgcn_model.eval()
+    if INFERENCE_MODE == 'int8':
+        rgcn_model = quantize_model(rgcn_model)
+    if INFERENCE_ENGINE == 'star':
+        check_star_parity(rgcn_model)
+
+    store_dir = os.path.join(model_dir, EMBEDDING_STORE_DIR)
+    if os.path.isdir(store_dir):
+        global EMBEDDING_STORE
+        EMBEDDING_STORE = EmbeddingStore(store_dir, EMBEDDING_STORE_FALLBACK)
+        print('--Embedding store: {}'.format(sorted(EMBEDDING_STORE.tables.keys())))
+
+    if WARMUP_ROUNDS > 0:
+        warm_up(rgcn_model, WARMUP_ROUNDS, WARMUP_SIZES)
 
     e_t = dt.now()
     print('--Load Model: {}'.format((e_t - s_t).microseconds))
@@ -154,6 +416,38 @@ def model_fn(model_dir):
     return rgcn_model
 
 
+def gather_features(in_feat, old_ids):
+    """
+    Gather the feature rows of nodes in the order of old_ids, without per-node Python work.
+
+    :param
+    in_feat: either a dictionary with node ids as key and a list of floats as value, or a tuple of an array of node ids
+             and a float32 matrix of their features in the same order.
+    old_ids: a sorted array of unique node ids.
+
+    :return: a float32 numpy matrix whose i-th row is the features of old_ids[i].
+    """
+    if isinstance(in_feat, dict):
+        feat_ids = np.array(list(in_feat.keys()))
+        feat_values = np.array(list(in_feat.values()), dtype=np.float32)
+    else:
+        feat_ids, feat_values = in_feat
+        feat_values = np.asarray(feat_values, dtype=np.float32)
+
+    # node ids of features are strings in JSON requests, compare them as strings
+    feat_ids = np.asarray(feat_ids).astype(str)
+    query_ids = np.asarray(old_ids).astype(str)
+
+    sorter = np.argsort(feat_ids)
+    pos = np.searchsorted(feat_ids, query_ids, sorter=sorter)
+    rows = sorter[np.minimum(pos, feat_ids.size - 1)]
+    missing = feat_ids[rows] != query_ids
+    if missing.any():
+        raise KeyError('No features of nodes {}'.format(query_ids[missing].tolist()))
+
+    return feat_values[rows]
+
+
 def recreate_grpha_data(graph_dict, n_feats, target_id):
     """
     From the graph dictionary, build the input graph and node features for model.
@@ -163,68 +457,50 @@ def recreate_grpha_data(graph_dict, n_feats, target_id):
                 'card1'), and the value is a tuple of two Python lists, containing the original ids of source and
                 destination nodes.
     n_feats: a Python dictionary, where key is node type string, and value is another dictionary with node ids as key and
-             value is a list of 390 dimension floats.
-    target_id: an id of a node in the graph to be inferred.
+             value is a list of 390 dimension floats, or a tuple of a node id array and a float32 feature matrix.
+             Non-target node types without features are looked up in the embedding store of the model by node ids.
+    target_id: an id of a node in the graph to be inferred, or a list of such ids.
 
     :return:
-    graph: a DGL heterogeneous graph, including reversed edges.
+    graph: a DGL heterogeneous graph, including reversed edges, or a StarGraph for the 'star' engine.
 
     new_n_feats: a Tensor in the order of new id nodes.
 
-    new_pred_target_id: an integer for the target node in the new graph
+    new_pred_target_id: an integer for the target node in the new graph, or a Tensor of them for a list of target ids
 
     """
     print('------------------ Convert to DLG Graph -------------------')
-    # --- Step 1: collect all types of nodes together
+    # --- Step 1: collect all types of nodes together, remembering where each relation's ids start
     rel_list = []
     node_id_list = {}
+    node_id_cnt = {}
     for can_etype, src_dst_tuple in graph_dict.items():
 
         src_type, dst_type = can_etype.split('<>')
-        src_origin, dst_origin = np.array(src_dst_tuple[0]), np.array(src_dst_tuple[1])
+        src_origin, dst_origin = np.asarray(src_dst_tuple[0]), np.asarray(src_dst_tuple[1])
 
-        rel_list.append(((src_type, dst_type), (src_origin, dst_origin)))
-        # rel_list.append(((dst_type, dst_type + '<>' + src_type, src_type), (dst_origin, src_origin)))
+        src_offset = node_id_cnt.get(src_type, 0)
+        node_id_list.setdefault(src_type, []).append(src_origin)
+        node_id_cnt[src_type] = src_offset + src_origin.size
 
-        if node_id_list.get(src_type) is not None:
-            node_id_list[src_type] = np.append(node_id_list.get(src_type), src_origin)
-        else:
-            node_id_list[src_type] = src_origin
+        dst_offset = node_id_cnt.get(dst_type, 0)
+        node_id_list.setdefault(dst_type, []).append(dst_origin)
+        node_id_cnt[dst_type] = dst_offset + dst_origin.size
 
-        if node_id_list.get(dst_type) is not None:
-            node_id_list[dst_type] = np.append(node_id_list.get(dst_type), dst_origin)
-        else:
-            node_id_list[dst_type] = dst_origin
+        rel_list.append(((src_type, dst_type), (src_offset, src_origin.size), (dst_offset, dst_origin.size)))
 
     # --- Step 2: for each type of node, unique their IDs and store
     node_new_list = {}
-    for ntype, nid_list in node_id_list.items():
+    for ntype, nid_lists in node_id_list.items():
         # get new id
-        nid_old, nid_new = np.unique(nid_list, return_inverse=True)
+        nid_old, nid_new = np.unique(np.concatenate(nid_lists), return_inverse=True)
         node_new_list[ntype] = (nid_old, nid_new)
 
     # ---  Step 3: map new node IDs to old node IDs
     rel_dict = {}
-    node_type_idx = {}
-    for rel in rel_list:
-        src_type, dst_type = rel[0]
-        src, dst = rel[1]
-
-        _, nid_new = node_new_list[src_type]
-        if node_type_idx.get(src_type) is not None:
-            src_new = nid_new[node_type_idx.get(src_type):node_type_idx.get(src_type) + src.size]
-            node_type_idx[src_type] = node_type_idx.get(src_type) + src.size
-        else:
-            src_new = nid_new[0: 0 + src.size]
-            node_type_idx[src_type] = 0 + src.size
-
-        _, nid_new = node_new_list[dst_type]
-        if node_type_idx.get(dst_type) is not None:
-            dst_new = nid_new[node_type_idx.get(dst_type):node_type_idx.get(dst_type) + dst.size]
-            node_type_idx[dst_type] = node_type_idx.get(dst_type) + dst.size
-        else:
-            dst_new = nid_new[0: 0 + dst.size]
-            node_type_idx[dst_type] = 0 + dst.size
+    for (src_type, dst_type), (src_offset, src_size), (dst_offset, dst_size) in rel_list:
+        src_new = node_new_list[src_type][1][src_offset:src_offset + src_size]
+        dst_new = node_new_list[dst_type][1][dst_offset:dst_offset + dst_size]
 
         rel_dict[(src_type, src_type + '<>' + dst_type, dst_type)] = (th.from_numpy(src_new), th.from_numpy(dst_new))
         rel_dict[(dst_type, dst_type + '<>' + src_type, src_type)] = (th.from_numpy(dst_new), th.from_numpy(src_new))
@@ -236,57 +512,166 @@ def recreate_grpha_data(graph_dict, n_feats, target_id):
                                                        th.from_numpy(target_nid_new))
 
     # Extract the new target node id
-    new_pred_target_id = th.tensor(np.searchsorted(target_nid_old, target_id)).long()
+    if not np.isin(target_id, target_nid_old).all():
+        raise ValueError('Target nodes {} are not in the graph'.format(target_id))
+    new_pred_target_id = th.as_tensor(np.searchsorted(target_nid_old, target_id)).long()
 
     print("New target node id: {}".format(new_pred_target_id))
 
     # --- Step 4: process n_feats dictionary to get feature tensor
     new_n_feats = {}
-    for in_ntype, in_feat_dict in n_feats.items():
-        old_ids, _ = node_new_list[in_ntype]
-
-        feats = []
-        for old_id in old_ids:
-            feats.append(in_feat_dict[str(old_id)])
+    for in_ntype, (old_ids, _) in node_new_list.items():
+        if in_ntype in n_feats:
+            th_feat = th.from_numpy(gather_features(n_feats[in_ntype], old_ids))
+        elif in_ntype != 'target' and EMBEDDING_STORE is not None and in_ntype in EMBEDDING_STORE:
+            th_feat = th.from_numpy(EMBEDDING_STORE.gather(in_ntype, old_ids))
+        else:
+            # scoring without the features of a node type would silently give wrong probabilities
+            raise ValueError('No features of node type {} in the request or the embedding store'.format(in_ntype))
 
         if in_ntype == 'target':
             global TARGET_FEAT_MEAN, TARGET_FEAT_STD
-            np_feats = np.array(feats).astype(np.float32)
-            th_feat = th.from_numpy(np_feats)
-            norm_feat = (th_feat - TARGET_FEAT_MEAN) / TARGET_FEAT_STD
-
-            new_n_feats[in_ntype] = norm_feat
+            new_n_feats[in_ntype] = (th_feat - TARGET_FEAT_MEAN) / TARGET_FEAT_STD
         else:
-            new_n_feats[in_ntype] = th.Tensor(feats)
+            new_n_feats[in_ntype] = th_feat
 
-    # --- Step 5: build DGL graph
-    graph = dgl.heterograph(rel_dict)
+    # --- Step 5: build DGL graph, or only keep the edge arrays for the star engine
+    if INFERENCE_ENGINE == 'star':
+        graph = StarGraph(rel_dict, {ntype: nid_old.shape[0] for ntype, (nid_old, _) in node_new_list.items()})
+    else:
+        graph = dgl.heterograph(rel_dict)
     print(graph)
 
     return graph, new_n_feats, new_pred_target_id
 
 
+def merge_graph_data(graph_data_list):
+    """
+    Merge several recreated subgraphs into one graph with disjoint components, so that they can be scored by a single
+    forward pass. Subgraphs may have different node and edge types, missing types contribute no nodes or edges.
+
+    :param
+    graph_data_list: a list of (graph, new_n_feats, new_pred_target_id) tuples returned by recreate_grpha_data.
+
+    :return:
+    graph: a DGL heterogeneous graph or a StarGraph as the disjoint union of all subgraphs.
+
+    new_n_feats: a dictionary of feature Tensors, the features of each node type are concatenated in subgraph order.
+
+    new_pred_target_ids: a Tensor of the target node ids in the merged graph, in subgraph order.
+
+    """
+    if len(graph_data_list) == 1:
+        graph, new_n_feats, new_pred_target_id = graph_data_list[0]
+        return graph, new_n_feats, new_pred_target_id.reshape(-1)
+
+    rel_dict = {}
+    num_nodes_dict = {}
+    feat_lists = {}
+    new_pred_target_ids = []
+    for graph, new_n_feats, new_pred_target_id in graph_data_list:
+        for can_etype in graph.canonical_etypes:
+            src_type, _, dst_type = can_etype
+            src, dst = graph.edges(etype=can_etype)
+            src_list, dst_list = rel_dict.setdefault(can_etype, ([], []))
+            src_list.append(src + num_nodes_dict.get(src_type, 0))
+            dst_list.append(dst + num_nodes_dict.get(dst_type, 0))
+
+        new_pred_target_ids.append((new_pred_target_id + num_nodes_dict.get('target', 0)).reshape(-1))
+
+        for ntype in graph.ntypes:
+            num_nodes_dict[ntype] = num_nodes_dict.get(ntype, 0) + graph.number_of_nodes(ntype)
+        for ntype, feat in new_n_feats.items():
+            feat_lists.setdefault(ntype, []).append(feat)
+
+    rel_dict = {can_etype: (th.cat(src_list), th.cat(dst_list)) for can_etype, (src_list, dst_list) in rel_dict.items()}
+    if isinstance(graph_data_list[0][0], StarGraph):
+        graph = StarGraph(rel_dict, num_nodes_dict)
+    else:
+        graph = dgl.heterograph(rel_dict, num_nodes_dict=num_nodes_dict)
+    new_n_feats = {ntype: th.cat(feats) for ntype, feats in feat_lists.items()}
+
+    return graph, new_n_feats, th.cat(new_pred_target_ids)
+
+
+def load_npz_request(request_body):
+    """
+    Parse a request in npz format, which holds 'graph/<i>/<relation>/src' and 'graph/<i>/<relation>/dst' edge arrays,
+    'n_feats/<i>/<node type>/ids' and 'n_feats/<i>/<node type>/values' node id arrays and feature matrices of the i-th
+    subgraph, and the 'target_id' array of all subgraphs. An optional 'target_ids/<i>' array replaces the target id of
+    the i-th subgraph with several ones.
+
+    :param request_body: the bytes of npz container.
+
+    :return: a list of (graph_dict, n_feats, target_id) tuples in the same format of JSON requests, except that node
+             features of a type are a tuple of the node id array and the float32 feature matrix.
+    """
+    with np.load(io.BytesIO(request_body), allow_pickle=False) as npz:
+        arrays = {name: npz[name] for name in npz.files}
+
+    target_ids = arrays.pop('target_id').tolist()
+    graph_dicts = [{} for _ in target_ids]
+    n_feats = [{} for _ in target_ids]
+    for name, array in arrays.items():
+        if name.startswith('target_ids/'):
+            target_ids[int(name.split('/')[1])] = array.tolist()
+            continue
+        kind, i, key, field = name.split('/')
+        if kind == 'graph':
+            src_dst = graph_dicts[int(i)].setdefault(key, [None, None])
+            src_dst[0 if field == 'src' else 1] = array
+        else:
+            ids_values = n_feats[int(i)].setdefault(key, [None, None])
+            ids_values[0 if field == 'ids' else 1] = array
+
+    n_feats = [{ntype: tuple(ids_values) for ntype, ids_values in n_feat.items()} for n_feat in n_feats]
+
+    return list(zip(graph_dicts, n_feats, target_ids))
+
+
 def input_fn(request_body, request_content_type='application/json'):
     """
-    Preprocessing request_body that is in JSON format.
+    Preprocessing request_body that is in JSON or npz format.
+    A JSON request either holds one subgraph with its 'graph', 'n_feats' and 'target_id', or a 'batch' list of such
+    subgraphs that are merged to be scored together. A npz request is always handled as a batch.
+    The 'target_id' of a subgraph can be a list of target node ids, which are all scored by the same forward pass. The
+    response is then the list of their probabilities, and the probabilities of all targets of a batch are listed in
+    subgraph order.
+    A list of request bodies is a batch of requests collected by the model server, each of them is parsed on its own and
+    predict_fn scores them together.
     :param request_body:
     :param request_content_type:
     :return:
     """
+    if isinstance(request_body, list):
+        content_types = request_content_type if isinstance(request_content_type, list) \
+            else [request_content_type] * len(request_body)
+        return [input_fn(body, content_type) for body, content_type in zip(request_body, content_types)]
+
     print('--START a session... ')
 
     # --------------------- receive request ------------------------------------------------ #
-    input_data = json.loads(request_body)
-
     s_t = dt.now()
 
-    subgraph_dict = input_data['graph']
-    n_feats = input_data['n_feats']
-    target_id = input_data['target_id']
+    if request_content_type == NPZ_CONTENT_TYPE:
+        graph_data_list = [recreate_grpha_data(subgraph_dict, n_feats, target_id)
+                           for subgraph_dict, n_feats, target_id in load_npz_request(request_body)]
+        graph, new_n_feats, new_pred_target_id = merge_graph_data(graph_data_list)
+    else:
+        input_data = json.loads(request_body)
+
+        if 'batch' in input_data:
+            graph_data_list = [recreate_grpha_data(sub_data['graph'], sub_data['n_feats'], sub_data['target_id'])
+                               for sub_data in input_data['batch']]
+            graph, new_n_feats, new_pred_target_id = merge_graph_data(graph_data_list)
+        else:
+            subgraph_dict = input_data['graph']
+            n_feats = input_data['n_feats']
+            target_id = input_data['target_id']
 
-    # print(n_feats)
+            # print(n_feats)
 
-    graph, new_n_feats, new_pred_target_id = recreate_grpha_data(subgraph_dict, n_feats, target_id)
+            graph, new_n_feats, new_pred_target_id = recreate_grpha_data(subgraph_dict, n_feats, target_id)
 
     e_t = dt.now()
     print('--DP: {}'.format((e_t - s_t).microseconds))
@@ -299,7 +684,11 @@ def predict_fn(input_data, model):
     # ---------------------  Inference ------------------------------------------------ #
     s_t = dt.now()
 
-    graph, new_n_feats, new_pred_target_id = input_data
+    # the requests of a model server batch are merged into one graph and scored by a single forward pass
+    if isinstance(input_data, list):
+        graph, new_n_feats, new_pred_target_id = merge_graph_data(input_data)
+    else:
+        graph, new_n_feats, new_pred_target_id = input_data
 
     with th.no_grad():
         logits = model(graph, new_n_feats)
@@ -308,7 +697,22 @@ def predict_fn(input_data, model):
     e_t = dt.now()
     print('--MI: {} --END'.format((e_t - s_t).microseconds))
 
-    return res[1]
+    if isinstance(input_data, list):
+        # split the scores back per request, in the order of requests
+        sizes = [target_id.numel() for _, _, target_id in input_data]
+        return [target_probs(request_res, target_id)
+                for request_res, (_, _, target_id) in zip(np.split(res, np.cumsum(sizes)[:-1]), input_data)]
+
+    return target_probs(res, new_pred_target_id)
+
+
+def target_probs(res, target_id):
+    """The fraud probability of a request of a single target, or the probabilities of all targets of a batch request"""
+    probs = res.reshape(-1, res.shape[-1])[:, 1]
+    if target_id.dim() > 0:
+        return probs
+
+    return probs[0]
 
 
 if __name__ == '__main__':
@@ -1,38 +1,45 @@
 import numpy as np
 import pandas as pd
 
-def get_features(id_to_node, node_feature_files):
+def get_features(id_to_node, node_feature_files, out_file=None, chunk_size=10000):
     """
 
     :param id_to_node: dictionary mapping node names(id) to dgl node idx
     :param node_features: path to file containing node features
+    :param out_file: optional path of a .npy file the feature matrix is memory-mapped to
+    :param chunk_size: number of rows parsed at a time
     :return: (np.ndarray, list) node feature matrix in order and new nodes not yet in the graph
     """
-    indices, features, new_nodes = [], [], []
-    max_node = max(id_to_node.values())
+    node_feature_files = list(node_feature_files)
 
+    # 1st pass: only read node ids to index new nodes and size the feature matrix
+    file_indices, new_nodes, num_feats = [], [], 0
     for node_file in node_feature_files:
-        is_1st_line = True
-        with open(node_file, "r") as fh:
-            for line in fh:
-                # hard-coding to ignore the 1st line of header
-                if is_1st_line:
-                    is_1st_line = False
-                    continue
-    
-                node_feats = line.strip().split(",")
-                node_id = node_feats[0]
-                feats = np.array(list(map(float, node_feats[1:])))
-                features.append(feats)
-                if node_id not in id_to_node:
-                    max_node += 1
-                    id_to_node[node_id] = max_node
-                    new_nodes.append(max_node)
-    
-                indices.append(id_to_node[node_id])
-
-    features = np.array(features).astype('float32')
-    features = features[np.argsort(indices), :]
+        node_ids = pd.read_csv(node_file, usecols=[0], dtype=str, na_filter=False).iloc[:, 0].values
+        indices, file_new_nodes = _map_node_ids(id_to_node, node_ids)
+        file_indices.append(indices)
+        new_nodes.extend(file_new_nodes)
+        num_feats = max(num_feats, len(pd.read_csv(node_file, nrows=0).columns) - 1)
+
+    shape = (max(id_to_node.values()) + 1, num_feats)
+    if out_file is not None:
+        features = np.lib.format.open_memmap(out_file, mode='w+', dtype=np.float32, shape=shape)
+    else:
+        features = np.zeros(shape, dtype=np.float32)
+
+    # 2nd pass: parse features chunk by chunk into the rows of their nodes
+    for node_file, indices in zip(node_feature_files, file_indices):
+        columns = pd.read_csv(node_file, nrows=0).columns
+        dtypes = {col: np.float32 for col in columns[1:]}
+        dtypes[columns[0]] = str
+        offset = 0
+        for chunk in pd.read_csv(node_file, dtype=dtypes, chunksize=chunk_size):
+            features[indices[offset:offset + len(chunk)], :] = chunk.iloc[:, 1:].values
+            offset += len(chunk)
+
+    if out_file is not None:
+        features.flush()
+
     return features, new_nodes
 
 def loadDF(f):
@@ -101,58 +108,65 @@ def _get_mask(id_to_node, node_to_id, num_nodes, masked_nodes, additional_mask_r
     return train_mask, test_mask
 
 
-def _get_node_idx(id_to_node, node_type, node_id, ptr):
-    if node_type in id_to_node:
-        if node_id in id_to_node[node_type]:
-            node_idx = id_to_node[node_type][node_id]
-        else:
-            id_to_node[node_type][node_id] = ptr
-            node_idx = ptr
-            ptr += 1
-    else:
-        id_to_node[node_type] = {}
-        id_to_node[node_type][node_id] = ptr
-        node_idx = ptr
-        ptr += 1
+def _map_node_ids(mapping, node_ids):
+    """
+    Map an array of node names(id) to dgl node indices, new names get the next indices in order of first appearance
 
-    return node_idx, id_to_node, ptr
+    :param mapping: dictionary mapping node names(id) of a node type to dgl node indices, updated with new names
+    :param node_ids: array of node names(id)
+    :return: (np.ndarray, range) int64 array of dgl node indices and the indices of new nodes
+    """
+    # only the distinct names of this array are looked up, so the cost does not grow with the names mapped so far
+    codes, uniques = pd.factorize(node_ids)
+    unique_idx = np.fromiter((mapping.get(node_id, -1) for node_id in uniques), dtype=np.int64, count=len(uniques))
+    is_new = unique_idx < 0
+    # indices are assigned contiguously, so the next one is the number of names mapped so far
+    ptr = len(mapping)
+    new_nodes = range(ptr, ptr + int(is_new.sum()))
+    unique_idx[is_new] = np.arange(new_nodes.start, new_nodes.stop)
+    mapping.update(zip(uniques[is_new], new_nodes))
+
+    return unique_idx[codes], new_nodes
+
+
+def _get_node_idx(id_to_node, node_type, node_ids):
+    """
+    Map an array of node names(id) of a node type to dgl node indices
+
+    :param id_to_node: dictionary containing mapping for node names(id) to dgl node indices
+    :param node_type: type of the nodes
+    :param node_ids: array of node names(id)
+    :return: (np.ndarray, dict) int64 array of dgl node indices and updated id_to_node dict
+    """
+    node_idx, _ = _map_node_ids(id_to_node.setdefault(node_type, {}), node_ids)
+    return node_idx, id_to_node
 
 
 def parse_edgelist(edges, id_to_node, header=False, source_type='user', sink_type='user'):
     """
-    Parse an edgelist path file and return the edges as a list of tuple
+    Parse an edgelist path file and return the edges as arrays of source and sink node indices
     :param edges: path to comma separated file containing bipartite edges with header for edgetype
     :param id_to_node: dictionary containing mapping for node names(id) to dgl node indices
     :param header: boolean whether or not the file has a header row
     :param source_type: type of the source node in the edge. defaults to 'user' if no header
     :param sink_type: type of the sink node in the edge. defaults to 'user' if no header.
-    :return: (list, dict) a list containing edges of a single relationship type as tuples and updated id_to_node dict.
-    """
-    edge_list = []
-    rev_edge_list = []
-    source_pointer, sink_pointer = 0, 0
-    with open(edges, "r") as fh:
-        for i, line in enumerate(fh):
-            source, sink = [col.strip('"') for col in line.strip().split(",")]
-            if i == 0:
-                if header:
-                    source_type, sink_type = source, sink
-                if source_type in id_to_node:
-                    source_pointer = max(id_to_node[source_type].values()) + 1
-                if sink_type in id_to_node:
-                    sink_pointer = max(id_to_node[sink_type].values()) + 1
-                continue
-
-            source_node, id_to_node, source_pointer = _get_node_idx(id_to_node, source_type, source, source_pointer)
-            if source_type == sink_type:
-                sink_node, id_to_node, source_pointer = _get_node_idx(id_to_node, sink_type, sink, source_pointer)
-            else:
-                sink_node, id_to_node, sink_pointer = _get_node_idx(id_to_node, sink_type, sink, sink_pointer)
-
-            edge_list.append((source_node, sink_node))
-            rev_edge_list.append((sink_node, source_node))
-
-    return edge_list, rev_edge_list, id_to_node, source_type, sink_type
+    :return: (np.ndarray, np.ndarray, dict, str, str) int64 arrays of source and sink node indices of a single
+    relationship type, updated id_to_node dict, and the source and sink node types.
+    """
+    edges_df = pd.read_csv(edges, header=0 if header else None, dtype=str, na_filter=False)
+    if header:
+        source_type, sink_type = edges_df.columns[:2]
+    sources, sinks = edges_df.iloc[:, 0].values, edges_df.iloc[:, 1].values
+
+    if source_type == sink_type:
+        # both ends share indices, assigned in the order nodes appear in rows
+        node_idx, id_to_node = _get_node_idx(id_to_node, source_type, np.column_stack([sources, sinks]).ravel())
+        source_nodes, sink_nodes = node_idx[0::2], node_idx[1::2]
+    else:
+        source_nodes, id_to_node = _get_node_idx(id_to_node, source_type, sources)
+        sink_nodes, id_to_node = _get_node_idx(id_to_node, sink_type, sinks)
+
+    return source_nodes, sink_nodes, id_to_node, source_type, sink_type
 
 
 def read_edges(edges, nodes=None):
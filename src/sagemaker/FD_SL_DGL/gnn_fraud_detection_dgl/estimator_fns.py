@@ -1,4 +1,5 @@
 import os
+import json
 import argparse
 import logging
 
@@ -14,6 +15,14 @@ def parse_args():
     parser.add_argument('--edges', type=str, default='homogeneous_edgelist.csv')
     parser.add_argument('--labels', type=str, default='tags.csv')
     parser.add_argument('--new-accounts', type=str, default='test.csv')
+    parser.add_argument('--graph-cache-dir', type=str, default='',
+                        help='folder of binary graph caches of input files, empty to disable caching. The training '
+                             'pipeline does not set it, it is meant for manual jobs, e.g. a folder under '
+                             '/opt/ml/checkpoints of a job with a checkpoint config to keep caches across jobs')
+    parser.add_argument('--features-mmap-file', type=str, default='',
+                        help='.npy file the target node features of the input files or the graph cache are written '
+                             'to and normalized in, memory-mapped to keep large feature matrices out of memory, empty '
+                             'to read them in memory')
     parser.add_argument('--compute-metrics', type=lambda x: (str(x).lower() in ['true', '1', 'yes']),
                         default=True, help='compute evaluation metrics after training')
     parser.add_argument('--threshold', type=float, default=0, help='threshold for making predictions, default : argmax')
@@ -26,6 +35,22 @@ def parse_args():
     parser.add_argument('--weight-decay', type=float, default=5e-4, help='Weight for L2 loss')
     parser.add_argument('--dropout', type=float, default=0.2, help='dropout probability, for gat only features')
     parser.add_argument('--embedding-size', type=int, default=360, help="embedding size for node embedding")
+    parser.add_argument('--mini-batch', type=lambda x: (str(x).lower() in ['true', '1', 'yes']),
+                        default=False, help='train on sampled neighbors of batches of target nodes, instead of full graph')
+    parser.add_argument('--batch-size', type=int, default=1024, help='number of target nodes per mini-batch')
+    parser.add_argument('--fanouts', type=str, default='10',
+                        help='comma separated numbers of sampled neighbors per relation of each layer, '
+                             'a single number applies to all layers')
+    parser.add_argument('--relation-fanouts', type=str, default='',
+                        help='comma separated <relation>:<number> overrides of fanouts for all layers, '
+                             'e.g. target<>card1:20')
+    parser.add_argument('--hosts', type=json.loads, default=os.environ.get('SM_HOSTS', '["localhost"]'),
+                        help='JSON list of the hosts of distributed training')
+    parser.add_argument('--current-host', type=str, default=os.environ.get('SM_CURRENT_HOST', 'localhost'))
+    parser.add_argument('--num-workers', type=int, default=1,
+                        help='number of training processes per host, training is distributed with more than one '
+                             'process in total, which requires --mini-batch')
+    parser.add_argument('--dist-port', type=int, default=29500, help='port of the gloo process group on the 1st host')
 
     return parser.parse_args()
 
@@ -17,16 +17,76 @@ import pickle
 
 from sklearn.metrics import confusion_matrix
 from estimator_fns import parse_args, get_logger
-from graph_utils import get_files, construct_graph
+from graph_utils import get_files, construct_graph, get_graph_cache_path, save_graph_cache, load_graph_cache
 from data import get_features, get_labels, read_masked_nodes, parse_edgelist, read_edges
 from utils import get_metrics
 from pytorch_model import HeteroRGCN
+from props_codec import encode_props, columns_digest
 
 
-def normalize(feature_matrix):
+def normalize(feature_matrix, chunk_size=100000):
+    """
+    Standardize the feature matrix in place chunk by chunk, so that features memory-mapped to a file stay backed by it
+    instead of being copied into memory
+    """
     mean = th.mean(feature_matrix, axis=0)
-    stdev = th.sqrt(th.sum((feature_matrix - mean)**2, axis=0)/feature_matrix.shape[0])
-    return mean, stdev, (feature_matrix - mean) / stdev
+    square_sum = th.zeros_like(mean)
+    for start in range(0, feature_matrix.shape[0], chunk_size):
+        square_sum += th.sum((feature_matrix[start:start + chunk_size] - mean)**2, axis=0)
+    stdev = th.sqrt(square_sum/feature_matrix.shape[0])
+    for start in range(0, feature_matrix.shape[0], chunk_size):
+        feature_matrix[start:start + chunk_size].sub_(mean).div_(stdev)
+    return mean, stdev, feature_matrix
+
+
+def broadcast_parameters(model):
+    """Start the workers of distributed training from the parameters of the 1st worker"""
+    for param in model.parameters():
+        th.distributed.broadcast(param.data, 0)
+
+
+def all_reduce_gradients(model, input_nodes, world_size):
+    """
+    Average the gradients of a mini-batch over the workers of distributed training. A batch only touches the embeddings
+    of its input nodes, so the touched rows of node embeddings are gathered from the workers instead of all-reducing
+    the whole embedding tables.
+
+    :param model: the RGCN model after the backward pass
+    :param input_nodes: dictionary from node types to the input nodes of the batch
+    :param world_size: number of workers
+    """
+    dense_params = [param for name, param in model.named_parameters() if not name.startswith('embed.')]
+    flat_grad = th.cat([(param.grad if param.grad is not None else th.zeros_like(param)).reshape(-1)
+                        for param in dense_params])
+    th.distributed.all_reduce(flat_grad)
+    flat_grad /= world_size
+    offset = 0
+    for param in dense_params:
+        param.grad = flat_grad[offset:offset + param.numel()].view_as(param).clone()
+        offset += param.numel()
+
+    ntypes = list(model.embed.keys())
+    rows = {ntype: input_nodes.get(ntype, th.zeros(0, dtype=th.int64)).cpu() for ntype in ntypes}
+    # the gathered tensors must have the same size on every worker, so rows are padded to the largest batch
+    max_rows = th.tensor([len(rows[ntype]) for ntype in ntypes])
+    th.distributed.all_reduce(max_rows, op=th.distributed.ReduceOp.MAX)
+    for ntype, num_rows in zip(ntypes, max_rows.tolist()):
+        embed = model.embed[ntype]
+        padded_rows = th.zeros(num_rows, dtype=th.int64)
+        padded_rows[:len(rows[ntype])] = rows[ntype]
+        padded_grad = embed.new_zeros((num_rows, embed.shape[1]))
+        if embed.grad is not None:
+            padded_grad[:len(rows[ntype])] = embed.grad[rows[ntype]]
+
+        gathered_rows = [th.empty_like(padded_rows) for _ in range(world_size)]
+        gathered_grads = [th.empty_like(padded_grad) for _ in range(world_size)]
+        th.distributed.all_gather(gathered_rows, padded_rows)
+        th.distributed.all_gather(gathered_grads, padded_grad)
+
+        # padded rows have zero gradients, adding them to the 1st row changes nothing
+        grad = th.zeros_like(embed)
+        grad.index_add_(0, th.cat(gathered_rows), th.cat(gathered_grads) / world_size)
+        embed.grad = grad
 
 
 def train_fg(model, optim, loss, features, labels, train_g, test_g, test_mask,
@@ -80,6 +140,98 @@ def train_fg(model, optim, loss, features, labels, train_g, test_g, test_mask,
     return model, class_preds, pred_proba
 
 
+def get_fanouts(fanouts, relation_fanouts, etypes, n_layers):
+    """
+    Build the per-relation numbers of sampled neighbors of each layer from the fanouts arguments.
+
+    :param fanouts: comma separated numbers of sampled neighbors of each layer, or a single number for all layers
+    :param relation_fanouts: comma separated <relation>:<number> overrides for all layers
+    :param etypes: relation names of the graph
+    :param n_layers: number of RGCN layers
+    :return: a list of dictionaries from relation names to numbers of sampled neighbors, one per layer
+    """
+    layer_fanouts = [int(fanout) for fanout in fanouts.split(',')]
+    if len(layer_fanouts) == 1:
+        layer_fanouts = layer_fanouts * n_layers
+    if len(layer_fanouts) != n_layers:
+        raise ValueError('Got {} fanouts for {} layers'.format(len(layer_fanouts), n_layers))
+
+    overrides = {}
+    for relation_fanout in filter(None, relation_fanouts.split(',')):
+        etype, fanout = relation_fanout.rsplit(':', 1)
+        overrides[etype] = int(fanout)
+
+    return [{etype: overrides.get(etype, fanout) for etype in etypes} for fanout in layer_fanouts]
+
+
+def train_mb(model, optim, loss, features, labels, g, test_mask, device, n_epochs, thresh, fanouts, batch_size,
+             compute_metrics=True, rank=0, world_size=1):
+    """
+    A mini-batch version of RGCN training, which samples the neighbors of batches of labelled target nodes, in
+    distributed training each worker takes the seed nodes of its own partition of the labelled target nodes
+    """
+    train_mask = th.logical_not(test_mask)
+    train_idx = th.nonzero(train_mask, as_tuple=True)[0].cpu()
+    # pad the labelled nodes with the first ones to a multiple of the workers, so that all partitions have the same
+    # number of batches and no worker waits for the gradients of a batch the others never run
+    num_pad = -len(train_idx) % world_size
+    train_idx = th.cat([train_idx, train_idx[:num_pad]])[rank::world_size]
+
+    print("Train label: {}".format(train_mask.sum()))
+    print("Test label: {}".format(test_mask.sum()))
+
+    sampler = dgl.dataloading.MultiLayerNeighborSampler(fanouts)
+    dataloader = dgl.dataloading.NodeDataLoader(g, {'target': train_idx}, sampler,
+                                                batch_size=batch_size, shuffle=True, drop_last=False)
+
+    duration = []
+    for epoch in range(n_epochs):
+        tic = time.time()
+        loss_val = 0.
+        batch_preds, batch_labels = [], []
+
+        for input_nodes, output_nodes, blocks in dataloader:
+            blocks = [block.to(device) for block in blocks]
+            batch_label = labels[output_nodes['target']]
+
+            pred = model.forward_blocks(blocks, input_nodes, features)
+
+            l = loss(pred, batch_label)
+
+            optim.zero_grad()
+            l.backward()
+            if world_size > 1:
+                all_reduce_gradients(model, input_nodes, world_size)
+            optim.step()
+
+            loss_val += l.item()
+            batch_preds.append(th.argmax(pred, axis=1).detach().cpu())
+            batch_labels.append(batch_label.cpu())
+
+        duration.append(time.time() - tic)
+        # f1 of the predictions made while training the epoch, to avoid a full graph forward pass
+        precision, recall, metric = get_f1_score(th.cat(batch_labels).numpy(), th.cat(batch_preds).numpy())
+        print("Epoch {:05d} | Time(s) {:.4f} | Loss {:.4f} | f1 {:.4f} ".format(
+                epoch, np.mean(duration), loss_val, metric))
+
+    # the predictions are only used by the 1st worker, the others skip the pass over all target nodes
+    class_preds, pred_proba = None, None
+    if rank == 0:
+        class_preds, pred_proba = get_model_class_predictions_mb(model, g, features, sampler, batch_size,
+                                                                 device, threshold=thresh)
+
+    if compute_metrics:
+        acc, f1, p, r, roc, pr, ap, cm = get_metrics(class_preds, pred_proba, labels.cpu().numpy(),
+                                                     test_mask.cpu().numpy(), './')
+        print("Metrics")
+        print("""Confusion Matrix:
+                                {}
+                                f1: {:.4f}, precision: {:.4f}, recall: {:.4f}, acc: {:.4f}, roc: {:.4f}, pr: {:.4f}, ap: {:.4f}
+                             """.format(cm, f1, p, r, acc, roc, pr, ap))
+
+    return model, class_preds, pred_proba
+
+
 def get_f1_score(y_true, y_pred):
     """
     Only works for binary case.
@@ -114,6 +266,27 @@ def evaluate(model, g, features, labels, device):
 
 def get_model_class_predictions(model, g, features, labels, device, threshold=None):
     unnormalized_preds = model(g, features.to(device))
+    return get_class_predictions(unnormalized_preds, threshold)
+
+
+def get_model_class_predictions_mb(model, g, features, sampler, batch_size, device, threshold=None):
+    """Predict all target nodes batch by batch on their sampled neighbors"""
+    n_nodes = g.number_of_nodes('target')
+    dataloader = dgl.dataloading.NodeDataLoader(g, {'target': th.arange(n_nodes)}, sampler,
+                                                batch_size=batch_size, shuffle=False, drop_last=False)
+    unnormalized_preds = None
+    with th.no_grad():
+        for input_nodes, output_nodes, blocks in dataloader:
+            blocks = [block.to(device) for block in blocks]
+            pred = model.forward_blocks(blocks, input_nodes, features)
+            if unnormalized_preds is None:
+                unnormalized_preds = th.zeros((n_nodes, pred.shape[1]), device=pred.device)
+            unnormalized_preds[output_nodes['target']] = pred
+
+    return get_class_predictions(unnormalized_preds.cpu(), threshold)
+
+
+def get_class_predictions(unnormalized_preds, threshold=None):
     pred_proba = th.softmax(unnormalized_preds, dim=-1)
     if not threshold:
         return unnormalized_preds.argmax(axis=1).detach().numpy(), pred_proba[:,1].detach().numpy()
@@ -125,6 +298,17 @@ def save_model(g, model, model_dir, id_to_node, mean, stdev):
     # Save Pytorch model's parameters to model.pth
     th.save(model.state_dict(), os.path.join(model_dir, 'model.pth'))
 
+    # Save an inference-only checkpoint without the node embedding tables, which the real-time endpoint never reads as
+    # embeddings of non-target nodes are sent along with each request.
+    th.save({'state_dict': {name: param for name, param in model.state_dict().items() if not name.startswith('embed.')},
+             'etypes': [can_etype for src_type, can_etype, dst_type in g.canonical_etypes],
+             'in_size': model.layers[0].weight[g.etypes[0]].in_features,
+             'hidden_size': model.layers[-1].in_features,
+             'out_size': model.layers[-1].out_features,
+             'n_layers': len(model.layers) - 1,
+             'feat_mean': mean,
+             'feat_std': stdev}, os.path.join(model_dir, 'model_inference.pth'))
+
     # Save graph's structure information to metadata.pkl for inference codes to initialize RGCN model.
     etype_list = g.canonical_etypes
     ntype_cnt = {ntype: g.number_of_nodes(ntype) for ntype in g.ntypes}
@@ -136,6 +320,7 @@ def save_model(g, model, model_dir, id_to_node, mean, stdev):
 
     # Save original IDs to Node_ids, and trained embedding for non-target node type
     # Covert id_to_node into pandas dataframes
+    os.makedirs(os.path.join(model_dir, 'embeddings'), exist_ok=True)
     for ntype, mapping in id_to_node.items():
 
         # ignore target node
@@ -155,19 +340,37 @@ def save_model(g, model, model_dir, id_to_node, mean, stdev):
         num_nodes = node_feats.shape[0]
         num_feats = node_feats.shape[1]
 
+        # dump the embeddings as a matrix the endpoint can memory-map, with the original id of each row and the mean
+        # embedding for unseen ids
+        row_ids = np.empty(num_nodes, dtype=object)
+        row_ids[node_id_list] = old_id_list
+        np.save(os.path.join(model_dir, 'embeddings', ntype + '.npy'), node_feats.astype(np.float32))
+        np.savez(os.path.join(model_dir, 'embeddings', ntype + '_index.npz'),
+                 ids=row_ids.astype(str), mean=node_feats.mean(axis=0).astype(np.float32))
+
         # create id dataframe
         node_ids_df = pd.DataFrame({'~label': [ntype] * num_nodes})
         node_ids_df['~id_tmp'] = old_id_list
         node_ids_df['~id'] = node_ids_df['~id_tmp'].apply(lambda col: f'{ntype}-{col}')
         node_ids_df['node_id'] = node_id_list
 
-        # create feature dataframe columns
-        cols = {'val' + str(i + 1): node_feats[:, i] for i in range(num_feats)}
-        node_feats_df = pd.DataFrame(cols)
-        json_props_df = node_feats_df.apply(lambda row: json.dumps(dict(row), default=str), axis=1).to_frame('props_values:String') 
+        # create feature dataframe column of packed vectors
+        cols = ['val' + str(i + 1) for i in range(num_feats)]
+        digest = columns_digest(cols)
+        props_df = pd.DataFrame({'props_values:String': [encode_props(feats, cols, digest) for feats in node_feats]})
+
+        # create feature dataframe column of the embeddings projected by the first layer's weight of the relation to
+        # target nodes, which the inference can use directly instead of the embeddings
+        proj_etype = ntype + '<>target'
+        if proj_etype in model.layers[0].weight:
+            with th.no_grad():
+                node_projs = model.layers[0].weight[proj_etype](model.embed[ntype]).numpy()
+            proj_cols = ['proj' + str(i + 1) for i in range(node_projs.shape[1])]
+            proj_digest = columns_digest(proj_cols)
+            props_df['proj_values:String'] = [encode_props(projs, proj_cols, proj_digest) for projs in node_projs]
 
         # merge id with feature, where feature_df use index
-        node_id_feats_df = node_ids_df.merge(json_props_df, left_on='node_id', right_on=json_props_df.index)
+        node_id_feats_df = node_ids_df.merge(props_df, left_on='node_id', right_on=props_df.index)
         # drop the id_tmp and node_id columns to follow the Grelim format requirements
         node_id_feats_df = node_id_feats_df.drop(['~id_tmp', 'node_id'], axis=1)
 
@@ -184,6 +387,78 @@ def get_model(ntype_dict, etypes, hyperparams, in_feats, n_classes, device):
     return model
 
 
+def run_training(local_rank, args, g, features, labels, test_mask, id_to_node, mean, stdev):
+    """
+    Train the RGCN model in one process. With several processes over the hosts, each process joins a gloo process
+    group, trains on its share of the labelled target nodes, and averages the gradients of each mini-batch over the
+    processes with all_reduce_gradients. The 1st process saves the model.
+    """
+    world_size = len(args.hosts) * args.num_workers
+    rank = args.hosts.index(args.current_host) * args.num_workers + local_rank
+
+    if features is None:
+        # the features normalized in place by the main process are mapped from their file
+        features = th.from_numpy(np.load(args.features_mmap_file, mmap_mode='r+'))
+
+    if world_size > 1:
+        th.set_num_threads(max(1, os.cpu_count() // args.num_workers))
+        th.distributed.init_process_group('gloo',
+                                          init_method='tcp://{}:{}'.format(args.hosts[0], args.dist_port),
+                                          rank=rank,
+                                          world_size=world_size)
+        print("Joined process group as worker {} of {}".format(rank, world_size))
+
+    if args.num_gpus:
+        cuda = True
+        device = th.device('cuda:0')
+    else:
+        cuda = False
+        device = th.device('cpu')
+
+    print("Initializing Model")
+    in_feats = features.shape[1]
+    n_classes = 2
+
+    ntype_dict = {n_type: g.number_of_nodes(n_type) for n_type in g.ntypes}
+
+    model = get_model(ntype_dict, g.etypes, vars(args), in_feats, n_classes, device)
+    n_layers = len(model.layers) - 1
+    if world_size > 1:
+        broadcast_parameters(model)
+    print("Initialized Model")
+
+    features = features.to(device)
+
+    labels = labels.long().to(device)
+    test_mask = test_mask.to(device)
+
+    loss = th.nn.CrossEntropyLoss(th.tensor([1, 12.]))
+
+    # print(model)
+    optim = th.optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
+
+    print("Starting Model training")
+    if args.mini_batch:
+        fanouts = get_fanouts(args.fanouts, args.relation_fanouts, g.etypes, n_layers)
+        model, class_preds, pred_proba = train_mb(model, optim, loss, features, labels, g,
+                                                  test_mask, device, args.n_epochs,
+                                                  args.threshold, fanouts, args.batch_size,
+                                                  args.compute_metrics and rank == 0, rank, world_size)
+    else:
+        model, class_preds, pred_proba = train_fg(model, optim, loss, features, labels, g, g,
+                                                  test_mask, device, args.n_epochs,
+                                                  args.threshold,  args.compute_metrics)
+    print("Finished Model training")
+
+    if rank == 0:
+        print("Saving model")
+        save_model(g, model, args.model_dir, id_to_node, mean, stdev)
+        print("Model and metadata saved")
+
+    if world_size > 1:
+        th.distributed.destroy_process_group()
+
+
 if __name__ == '__main__':
     logging = get_logger(__name__)
 
@@ -194,9 +469,41 @@ if __name__ == '__main__':
     args = parse_args()
     print(args)
 
-    g, features, target_id_to_node, id_to_node = construct_graph(get_files(args.edges, args.training_dir),
-                                                                 get_files(args.nodes, args.training_dir),
-                                                                 args.target_ntype)
+    # every worker of full graph training would compute the forward and backward pass of the whole graph
+    if len(args.hosts) * args.num_workers > 1 and not args.mini_batch:
+        raise ValueError('Distributed training over {} hosts with {} workers each requires --mini-batch'.format(
+            len(args.hosts), args.num_workers))
+
+    edge_files = list(get_files(args.edges, args.training_dir))
+    node_files = list(get_files(args.nodes, args.training_dir))
+    label_files = list(get_files(args.labels, args.training_dir))
+    new_account_files = list(get_files(args.new_accounts, args.training_dir))
+
+    graph_cache = None
+    if args.graph_cache_dir:
+        cache_path = get_graph_cache_path(args.graph_cache_dir,
+                                          [edge_files, node_files, label_files, new_account_files],
+                                          args.target_ntype)
+        graph_cache = load_graph_cache(cache_path, features_file=args.features_mmap_file or None)
+
+    if graph_cache is not None:
+        g, features, target_id_to_node, id_to_node, labels, test_mask = graph_cache
+    else:
+        g, features, target_id_to_node, id_to_node = construct_graph(edge_files, node_files, args.target_ntype,
+                                                                     features_file=args.features_mmap_file or None)
+
+        print("Getting labels")
+        n_nodes = g.number_of_nodes('target')
+
+        labels, _, test_mask = get_labels(target_id_to_node,
+                                                   n_nodes,
+                                                   args.target_ntype,
+                                                   label_files,
+                                                   new_account_files)
+        print("Got labels")
+
+        if args.graph_cache_dir:
+            save_graph_cache(cache_path, g, target_id_to_node, id_to_node, labels, test_mask)
 
     mean, stdev, features = normalize(th.from_numpy(features))
 
@@ -204,16 +511,6 @@ if __name__ == '__main__':
 
     g.nodes['target'].data['features'] = features
 
-    print("Getting labels")
-    n_nodes = g.number_of_nodes('target')
-
-    labels, _, test_mask = get_labels(target_id_to_node,
-                                               n_nodes,
-                                               args.target_ntype,
-                                               get_files(args.labels, args.training_dir),
-                                               get_files(args.new_accounts, args.training_dir))
-    print("Got labels")
-
     labels = th.from_numpy(labels).float()
     test_mask = th.from_numpy(test_mask).float()
 
@@ -229,38 +526,17 @@ if __name__ == '__main__':
                                                       features.shape,
                                                       test_mask.sum()))
 
-    if args.num_gpus:
-        cuda = True
-        device = th.device('cuda:0')
+    if len(args.hosts) * args.num_workers > 1:
+        # spawn the workers of this host, as forking after torch and DGL have started their OpenMP threads can hang the
+        # workers. The graph is pickled to each worker without the target features, which are passed on their own in
+        # shared memory or mapped again from their file.
+        del g.nodes['target'].data['features']
+        worker_features = None if args.features_mmap_file else features
+        for tensor in filter(lambda tensor: tensor is not None, (worker_features, labels, test_mask)):
+            tensor.share_memory_()
+        th.multiprocessing.start_processes(run_training,
+                                           args=(args, g, worker_features, labels, test_mask, id_to_node, mean, stdev),
+                                           nprocs=args.num_workers,
+                                           start_method='spawn')
     else:
-        cuda = False
-        device = th.device('cpu')
-
-    print("Initializing Model")
-    in_feats = features.shape[1]
-    n_classes = 2
-
-    ntype_dict = {n_type: g.number_of_nodes(n_type) for n_type in g.ntypes}
-
-    model = get_model(ntype_dict, g.etypes, vars(args), in_feats, n_classes, device)
-    print("Initialized Model")
-
-    features = features.to(device)
-
-    labels = labels.long().to(device)
-    test_mask = test_mask.to(device)
-
-    loss = th.nn.CrossEntropyLoss(th.tensor([1, 12.]))
-
-    # print(model)
-    optim = th.optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
-
-    print("Starting Model training")
-    model, class_preds, pred_proba = train_fg(model, optim, loss, features, labels, g, g,
-                                              test_mask, device, args.n_epochs,
-                                              args.threshold,  args.compute_metrics)
-    print("Finished Model training")
-
-    print("Saving model")
-    save_model(g, model, args.model_dir, id_to_node, mean, stdev)
-    print("Model and metadata saved")
+        run_training(0, args, g, features, labels, test_mask, id_to_node, mean, stdev)
@@ -1,5 +1,8 @@
 import os
 import re
+import shutil
+import hashlib
+import pickle
 import dgl
 import numpy as np
 import torch as th
@@ -10,15 +13,18 @@ from estimator_fns import get_logger
 
 logging = get_logger(__name__)
 
+# bump it when the graph construction or the cache layout changes, so caches of older code are not loaded
+GRAPH_CACHE_VERSION = 2
+
 def get_files(filename_pattern, root_dir):
     return glob.iglob(os.path.join(root_dir, '') + filename_pattern, recursive=True)
 
-def construct_graph(edges, nodes, target_node_type):
+def construct_graph(edges, nodes, target_node_type, features_file=None):
 
     print("Getting relation graphs from the following edge lists : {} ".format(edges))
     edgelists, id_to_node = {}, {}
     for i, edge in enumerate(edges):
-        edgelist, rev_edgelist, id_to_node, src, dst = parse_edgelist(edge, id_to_node, header=True)
+        src_nodes, dst_nodes, id_to_node, src, dst = parse_edgelist(edge, id_to_node, header=True)
         if src == target_node_type:
             src = 'target'
         if dst == target_node_type:
@@ -28,20 +34,24 @@ def construct_graph(edges, nodes, target_node_type):
             print("Will add self loop for target later......")
         else:
             if (src, src + '<>' + dst, dst) in edgelists:
-                edgelists[(src, src + '<>' + dst, dst)] = edgelists[(src, src + '<>' + dst, dst)] + edgelist
-                edgelists[(dst, dst + '<>' + src, src)] = edgelists[(dst, dst + '<>' + src, src)] +rev_edgelist
                 print("Append edges for {} from edgelist: {}".format(src + '<>' + dst, edge))
             else:
-                edgelists[(src, src + '<>' + dst, dst)] = edgelist
-                edgelists[(dst, dst + '<>' + src, src)] = rev_edgelist
                 print("Read edges for {} from edgelist: {}".format(src + '<>' + dst, edge))
+            edgelists.setdefault((src, src + '<>' + dst, dst), []).append((src_nodes, dst_nodes))
+            edgelists.setdefault((dst, dst + '<>' + src, src), []).append((dst_nodes, src_nodes))
 
     # get features for target nodes
-    features, new_nodes = get_features(id_to_node[target_node_type], nodes)
+    features, new_nodes = get_features(id_to_node[target_node_type], nodes, out_file=features_file)
     print("Read in features for target nodes")
 
+    # concatenate the edges of each relation read from several files
+    edgelists = {can_etype: (th.from_numpy(np.concatenate([src_nodes for src_nodes, _ in edge_arrays])),
+                             th.from_numpy(np.concatenate([dst_nodes for _, dst_nodes in edge_arrays])))
+                 for can_etype, edge_arrays in edgelists.items()}
+
     # add self relation
-    edgelists[('target', 'self_relation', 'target')] = [(t, t) for t in id_to_node[target_node_type].values()]
+    target_nodes = th.from_numpy(np.fromiter(id_to_node[target_node_type].values(), dtype=np.int64))
+    edgelists[('target', 'self_relation', 'target')] = (target_nodes, target_nodes)
 
     g = dgl.heterograph(edgelists)
     print(
@@ -57,3 +67,78 @@ def construct_graph(edges, nodes, target_node_type):
     del id_to_node[target_node_type]
 
     return g, features, target_id_to_node, id_to_node
+
+
+def get_graph_cache_path(cache_dir, file_groups, target_node_type):
+    """
+    Path of the graph cache of input files, keyed by a content hash of the files, the target node type and the cache
+    format version
+
+    :param cache_dir: folder of graph caches
+    :param file_groups: lists of input file paths, e.g. edge lists, node features, labels and masked nodes
+    :param target_node_type: column name for target node type
+    :return: the cache path of these input files
+    """
+    sha = hashlib.sha256('v{}:{}'.format(GRAPH_CACHE_VERSION, target_node_type).encode('utf-8'))
+    for files in file_groups:
+        for file_path in sorted(files):
+            sha.update(os.path.basename(file_path).encode('utf-8'))
+            with open(file_path, 'rb') as fh:
+                for block in iter(lambda: fh.read(1 << 20), b''):
+                    sha.update(block)
+    return os.path.join(cache_dir, sha.hexdigest()[:16])
+
+
+def save_graph_cache(cache_path, g, target_id_to_node, id_to_node, labels, test_mask):
+    """
+    Save the constructed graph with its target features, labels and test mask, and the node id mappings to cache_path
+    """
+    tmp_path = cache_path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    # the target features are saved on their own, so that loading the cache can memory-map them
+    features = g.nodes['target'].data.pop('features')
+    try:
+        dgl.save_graphs(os.path.join(tmp_path, 'graph.bin'), [g],
+                        {'labels': th.from_numpy(labels), 'test_mask': th.from_numpy(test_mask)})
+    finally:
+        g.nodes['target'].data['features'] = features
+    np.save(os.path.join(tmp_path, 'features.npy'), features.numpy())
+    with open(os.path.join(tmp_path, 'id_to_node.pkl'), 'wb') as f:
+        pickle.dump({'target_id_to_node': target_id_to_node, 'id_to_node': id_to_node}, f)
+
+    # a complete cache appears at once, even if the training is interrupted when saving it
+    shutil.rmtree(cache_path, ignore_errors=True)
+    os.rename(tmp_path, cache_path)
+    print("Saved graph cache to {}".format(cache_path))
+
+
+def load_graph_cache(cache_path, features_file=None):
+    """
+    Load the graph, target features, node id mappings, labels and test mask saved by save_graph_cache
+
+    :param cache_path: the cache path of input files
+    :param features_file: optional path of a .npy file the cached target features are copied to and memory-mapped from
+
+    :return: (DGLHeteroGraph, np.ndarray, dict, dict, np.ndarray, np.ndarray) the graph, target features,
+    target_id_to_node, id_to_node, labels and test mask, or None if no cache exists at cache_path
+    """
+    if not os.path.isdir(cache_path):
+        return None
+
+    graphs, tensors = dgl.load_graphs(os.path.join(cache_path, 'graph.bin'))
+    g = graphs[0]
+    with open(os.path.join(cache_path, 'id_to_node.pkl'), 'rb') as f:
+        mappings = pickle.load(f)
+    # the cache keeps the raw features, the copy is normalized in place by the training
+    if features_file is not None:
+        shutil.copyfile(os.path.join(cache_path, 'features.npy'), features_file)
+        features = np.load(features_file, mmap_mode='r+')
+    else:
+        features = np.load(os.path.join(cache_path, 'features.npy'))
+    g.nodes['target'].data['features'] = th.from_numpy(features)
+    print("Loaded graph cache from {}".format(cache_path))
+
+    return g, features, mappings['target_id_to_node'], mappings['id_to_node'], \
+        tensors['labels'].numpy(), tensors['test_mask'].numpy()
@@ -0,0 +1,68 @@
+"""
+    Compact encoding of the property vectors of vertices stored in the graph database.
+
+    A vector is stored as '<version>:<digest of column order>:<base64 of little-endian float32 values>', which replaces
+    the JSON dictionary keyed by column names. The same module is shipped with the Glue ETL script, the training code and
+    the inference function, keep the copies identical, test/props-codec.test.ts fails when they differ.
+"""
+
+import base64
+import hashlib
+import json
+
+import numpy as np
+
+PROPS_VERSION = 'f32v1'
+PROPS_DTYPE = '<f4'
+
+
+class ColumnsMismatchError(ValueError):
+    """A vector is encoded with another column order than the caller expects, e.g. the graph is loaded from the
+    output of another ETL run."""
+
+
+def columns_digest(cols):
+    """Short digest identifying the order of columns a vector is encoded with."""
+    return hashlib.sha1(','.join(cols).encode('utf-8')).hexdigest()[:8]
+
+
+def encode_props(values, cols, digest=None):
+    """
+    Encode a vector of values ordered as cols.
+
+    :param values: a sequence of numbers in the order of cols
+    :param cols: the list of column names of values
+    :param digest: precomputed columns_digest(cols), to save the hashing when encoding many vectors
+    :return: the encoded string
+    """
+    if digest is None:
+        digest = columns_digest(cols)
+    payload = base64.b64encode(np.asarray(values, dtype=PROPS_DTYPE).tobytes()).decode('ascii')
+    return '{}:{}:{}'.format(PROPS_VERSION, digest, payload)
+
+
+def decode_props(props, cols, digest=None):
+    """
+    Decode an encoded vector into a float32 array in the order of cols. Legacy JSON dictionaries keyed by column names
+    are decoded as well.
+
+    :param props: the encoded string
+    :param cols: the list of column names expected by the caller
+    :param digest: precomputed columns_digest(cols)
+    :return: a read-only float32 numpy array
+    :raise ColumnsMismatchError: if props is encoded with another column order
+    :raise ValueError: if props is malformed
+    """
+    if props.startswith(PROPS_VERSION + ':'):
+        _, props_digest, payload = props.split(':', 2)
+        if digest is None:
+            digest = columns_digest(cols)
+        if props_digest != digest:
+            raise ColumnsMismatchError('Property vector is encoded with columns {}, expected {}'.format(props_digest, digest))
+        values = np.frombuffer(base64.b64decode(payload), dtype=PROPS_DTYPE)
+        if values.size != len(cols):
+            raise ValueError('Property vector has {} values, expected {}'.format(values.size, len(cols)))
+        return values
+
+    json_val = json.loads(props)
+    return np.array([json_val[key] for key in cols], dtype=np.float32)
@@ -15,19 +15,23 @@ class HeteroRGCNLayer(nn.Module):
             })
 
     def forward(self, G, feat_dict):
-        # The input is a dictionary of node features for each type
+        # The input is a dictionary of node features for each type, G is either a graph or a block of sampled edges
+        # whose source nodes have the input features
+        src_nodes = G.srcnodes if G.is_block else G.nodes
         funcs = {}
         for srctype, etype, dsttype in G.canonical_etypes:
             # Compute W_r * h
             if srctype in feat_dict:
                 Wh = self.weight[etype](feat_dict[srctype])
                 # Save it in graph for message passing
-                G.nodes[srctype].data['Wh_%s' % etype] = Wh
+                src_nodes[srctype].data['Wh_%s' % etype] = Wh
                 # Specify per-relation message passing functions: (message_func, reduce_func).
                 funcs[etype] = (fn.copy_u('Wh_%s' % etype, 'm'), fn.mean('m', 'h'))
         # Trigger message passing of multiple types.
         G.multi_update_all(funcs, 'sum')
         # return the updated node feature dictionary
+        if G.is_block:
+            return {ntype: G.dstnodes[ntype].data['h'] for ntype in G.dsttypes if 'h' in G.dstnodes[ntype].data}
         return {ntype: G.nodes[ntype].data['h'] for ntype in G.ntypes if 'h' in G.nodes[ntype].data}
 
 
@@ -63,4 +67,18 @@ class HeteroRGCN(nn.Module):
             h_dict = layer(g, h_dict)
 
         # get user logits
+        return self.layers[-1](h_dict['target'])
+
+    def forward_blocks(self, blocks, input_nodes, features):
+        # get embeddings and features of the input nodes of sampled blocks, one block per layer
+        h_dict = {ntype: emb[input_nodes[ntype]] for ntype, emb in self.embed.items() if ntype in input_nodes}
+        h_dict['target'] = features[input_nodes['target']]
+
+        # pass through all layers
+        for i, (layer, block) in enumerate(zip(self.layers[:-1], blocks)):
+            if i != 0:
+                h_dict = {k: F.leaky_relu(h) for k, h in h_dict.items()}
+            h_dict = layer(block, h_dict)
+
+        # get user logits of the output nodes of the last block
         return self.layers[-1](h_dict['target'])
\ No newline at end of file
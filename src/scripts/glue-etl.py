@@ -8,11 +8,13 @@ from awsglue.context import GlueContext
 from awsglue.dynamicframe import DynamicFrame
 from awsglue.transforms import DropFields, SelectFields
 import pyspark.sql.functions as fc
+from pyspark.sql.types import StringType
 from io import BytesIO, StringIO
 import boto3
 from urllib.parse import urlparse
 from neptune_python_utils.glue_gremlin_csv_transforms import GlueGremlinCsvTransforms
 import databricks.koalas as ks
+from props_codec import encode_props, columns_digest
 
 def join_all(dfs, keys):
     if len(dfs) > 1:
@@ -129,7 +131,10 @@ logger.info(f'Dumping features and labels for training...')
 dump_df_to_s3(features_df, 'features')
 dump_df_to_s3(labels_df, 'tags')
 
-featurs_graph_df = features_df.withColumn('props_values:String', to_json(struct(list(filter(lambda x: (x != TRANSACTION_ID), features_df.schema.names)))))
+props_cols = list(filter(lambda x: (x != TRANSACTION_ID), features_df.schema.names))
+props_digest = columns_digest(props_cols)
+encode_props_udf = fc.udf(lambda values: encode_props(values, props_cols, props_digest), StringType())
+featurs_graph_df = features_df.withColumn('props_values:String', encode_props_udf(fc.array(*[fc.col(c).cast('float') for c in props_cols])))
 featurs_graph_df = featurs_graph_df.select('TransactionID','props_values:String')
 
 logger.info(f'Creating glue dynamic frame from spark dataframe...')
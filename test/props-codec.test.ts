@@ -0,0 +1,16 @@
+import * as fs from 'fs';
+import * as path from 'path';
+
+describe('props codec', () => {
+
+  test('the copies of props_codec.py are identical', () => {
+    const source = path.join(__dirname, '../src/scripts/props_codec.py');
+    const copies = [
+      '../src/lambda.d/inference/func/props_codec.py',
+      '../src/sagemaker/FD_SL_DGL/gnn_fraud_detection_dgl/props_codec.py',
+    ];
+    for (const copy of copies) {
+      expect(fs.readFileSync(path.join(__dirname, copy), 'utf8')).toEqual(fs.readFileSync(source, 'utf8'));
+    }
+  });
+});
@@ -971,7 +971,11 @@ describe('training stack test suite', () => {
               {
                 Ref: 'ETLCompGlueJobBucketEAA2FE1A',
               },
-              `/artifacts/${neptuneLibHash}/neptune_python_utils.zip`,
+              `/artifacts/${neptuneLibHash}/neptune_python_utils.zip,s3://`,
+              {
+                Ref: 'ETLCompGlueJobBucketEAA2FE1A',
+              },
+              `/artifacts/${scriptHash}/props_codec.py`,
             ],
           ],
         },
@@ -1202,7 +1206,7 @@ describe('training stack test suite', () => {
             {
               Ref: 'AWS::URLSuffix',
             },
-            "/pytorch-inference:1.6.0-cpu-py36-ubuntu16.04\",\"Mode\":\"SingleModel\",\"ModelDataUrl.$\":\"$.modelPackagingOutput.RepackagedArtifact\",\"Environment\":{\"SAGEMAKER_PROGRAM\":\"fd_sl_deployment_entry_point.py\",\"HIDDEN_SIZE.$\":\"$.parameters.trainingJob.hyperparameters['n-hidden']\"}}}},\"Create endpoint config\":{\"Next\":\"Check the existence of endpoint\",\"Catch\":[{\"ErrorEquals\":[\"States.ALL\"],\"ResultPath\":\"$.error\",\"Next\":\"Fail\"}],\"Type\":\"Task\",\"ResultPath\":\"$.endpointConfigOutput\",\"ResultSelector\":{\"EndpointConfigArn.$\":\"$.EndpointConfigArn\"},\"Resource\":\"arn:",
+            "/pytorch-inference:1.6.0-cpu-py36-ubuntu16.04\",\"Mode\":\"SingleModel\",\"ModelDataUrl.$\":\"$.modelPackagingOutput.RepackagedArtifact\",\"Environment\":{\"SAGEMAKER_PROGRAM\":\"fd_sl_deployment_entry_point.py\",\"HIDDEN_SIZE.$\":\"$.parameters.trainingJob.hyperparameters['n-hidden']\",\"SAGEMAKER_TS_BATCH_SIZE\":\"8\",\"SAGEMAKER_TS_MAX_BATCH_DELAY\":\"5\"}}}},\"Create endpoint config\":{\"Next\":\"Check the existence of endpoint\",\"Catch\":[{\"ErrorEquals\":[\"States.ALL\"],\"ResultPath\":\"$.error\",\"Next\":\"Fail\"}],\"Type\":\"Task\",\"ResultPath\":\"$.endpointConfigOutput\",\"ResultSelector\":{\"EndpointConfigArn.$\":\"$.EndpointConfigArn\"},\"Resource\":\"arn:",
             {
               Ref: 'AWS::Partition',
             },